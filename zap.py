@@ -4,43 +4,231 @@ import json
 import argparse
 import socket
 import zappytelnetlib
-import matplotlib.pyplot as plt
+from zappyledger import ZappyLedger
+from zappyspool import ZappySpool
+import zappyraster
+from zappypyramid import PyramidWriter
+import numpy as np
 from datetime import datetime
+from time import monotonic
 import csv
 from pathlib import Path
+import os
+import math
+import re
+import glob
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+import hashlib
+import threading
+import collections
 
 #test_parsed = json.loads(test)
 #test_voltage = test_parsed["voltage"].split(':')
 ENERGY_COEFF = 1.691356e-9
 ONEJOULE = 591241583.67
+LOG_DIR = '/opt/zappy/'
+
+# hard coded calibration parameters from zappy-01 for now
+FAST_M=230.156015 #215.7720466
+FAST_B=0.176922133 #-0.0488699
+SLOW_M=229.9235716
+SLOW_B=-0.008779325
+P5V_ADC=5.009
+
+CHUNK_SAMPLES = 65536   # capture samples converted and written at a time
+PLOT_POINTS = 4096      # most min/max buckets kept per trace for the PNG
+PLOT_ALIGN = 256        # PNG buckets divide or are multiples of this, the coarsest pyramid level
+SAMPLES_PER_MS = 1000   # captures are sampled every microsecond
+TRIM_MARGIN = 0.5       # ms kept past the pulse when trimming
+TRIM_THRESHOLD = 20.0   # fast channel volts that count as pulse for --trim detect
+
+# anomaly detection, as fractions of the target voltage or of the cap voltage
+PREAMBLE_MS = 1.0       # captures start this long before the pulse
+ANOMALY_EDGE = 0.05     # ms at either end of the pulse not checked, for the ramps
+CHARGED_RATIO = 0.5     # cap (slow) above this much of target counts as charged
+COLLAPSE_RATIO = 0.5    # on cell (fast) below this much of the cap is a collapse
+PULSE_RATIO = 0.5       # on cell above this much of target counts as pulse on
+ENERGY_OVERSHOOT = 0.1  # how far past an energy cutoff a pulse may still land
+CUTOFF_REACHED = 0.8    # share of an energy cutoff a pulse that ends early must deliver
+
+plot_lock = threading.Lock()
+# chassis threads may share a day's manifest
+manifest_lock = threading.Lock()
+
+
+class ZappyError(Exception):
+    """A command was rejected; raised instead of exit() when exit_on_error is off."""
+    pass
+
+
+class ZapResult():
+    """Outcome of one command.
+
+    status is 'zpass', 'zerr', 'timeout', 'error' (could not talk to the
+    chassis, nothing was sent), 'lost' (sent, but the link dropped before a
+    status came back, so it may have fired), 'invalid' (rejected before
+    sending) or 'dry_run'.  parameters
+    holds the parsed command with 1-based row/col and the duration without
+    the preamble; timings the parse/chassis/dump phases in milliseconds;
+    wells one WellResult per converted well.
+    """
+    def __init__(self, name, status=None, batch_row=None):
+        self.name = name
+        self.status = status
+        self.batch_row = batch_row
+        self.message = None
+        self.parameters = {}
+        self.timings = {}
+        self.wells = []
+
+    @property
+    def ok(self):
+        return self.status == 'zpass' or self.status == 'dry_run'
+
+    def __repr__(self):
+        return '<ZapResult ' + self.name + ' ' + str(self.status) + ' ' + str(len(self.wells)) + ' wells>'
+
+
+class WellResult():
+    """One well of a shot: energy, trace extremes, output files and, when
+    the ZappyJSON keeps waveforms, the capture itself.
+
+    slow_codes and fast_codes are the raw 16-bit ADC codes as compact numpy
+    arrays; slow and fast convert them to volts on access.
+    """
+    def __init__(self, row, col, energy_counts, samples=0):
+        self.row = row
+        self.col = col
+        self.energy_counts = energy_counts
+        self.energy_joules = energy_counts * ENERGY_COEFF
+        self.samples = samples
+        # where the kept samples sit in the capture file, when it was trimmed
+        self.offset = 0
+        self.capture_samples = samples
+        self.slow_min = None
+        self.slow_max = None
+        self.fast_min = None
+        self.fast_max = None
+        self.csv = None
+        self.png = None
+        self.slow_codes = None
+        self.fast_codes = None
+        # descriptions of whatever AnomalySink found wrong with the capture
+        self.anomalies = []
+
+    @property
+    def slow(self):
+        return None if self.slow_codes is None else slow_volts(self.slow_codes)
+
+    @property
+    def fast(self):
+        return None if self.fast_codes is None else fast_volts(self.fast_codes)
+
+    def update(self, slowg, fastg):
+        if len(slowg) == 0:
+            return
+        if self.slow_max is None:
+            self.slow_min, self.slow_max = float(slowg.min()), float(slowg.max())
+            self.fast_min, self.fast_max = float(fastg.min()), float(fastg.max())
+        else:
+            self.slow_min, self.slow_max = min(self.slow_min, float(slowg.min())), max(self.slow_max, float(slowg.max()))
+            self.fast_min, self.fast_max = min(self.fast_min, float(fastg.min())), max(self.fast_max, float(fastg.max()))
+
+    def summary(self):
+        """Everything but the waveforms, as a dict."""
+        return {
+            'row': self.row,
+            'col': self.col,
+            'energy_counts': self.energy_counts,
+            'energy_joules': self.energy_joules,
+            'samples': self.samples,
+            'offset': self.offset,
+            'slow_min': self.slow_min or 0.0,
+            'slow_max': self.slow_max or 0.0,
+            'fast_min': self.fast_min or 0.0,
+            'fast_max': self.fast_max or 0.0,
+            'csv': self.csv,
+            'png': self.png,
+            'anomalies': '; '.join(self.anomalies),
+        }
+
+    def __repr__(self):
+        return '<WellResult r' + str(self.row) + 'c' + str(self.col) + ' ' + '%.3f' % self.energy_joules + 'J ' + str(self.samples) + ' samples>'
+
 
 class ZappyJSON():
-    def __init__(self, target_ip="10.0.11.2", dry_run=False, verbose=False, prefix=None, no_png=False, serialize=False):
+    def __init__(self, target_ip="10.0.11.2", dry_run=False, verbose=False, prefix=None, no_png=False, serialize=False, ledger=None, log_dir=LOG_DIR,
+                 fast_png=False, keep_waveforms=False, exit_on_error=False, trim=None, trim_margin=TRIM_MARGIN, trim_threshold=TRIM_THRESHOLD,
+                 keep_alive=False, checkpoint=None, plate_heatmap=False, anomaly=None, load_band=None, layout='flat',
+                 post_jobs=None, aggregate=False, pyramid=False):
         self.target_ip = target_ip
         self.dry_run = dry_run
         self.verbose = verbose
         self.prefix = prefix
         self.no_png = no_png
         self.serialize = serialize
+        self.ledger = ledger
+        self.log_dir = log_dir
+        self.fast_png = fast_png
+        self.keep_waveforms = keep_waveforms
+        self.exit_on_error = exit_on_error
+        self.trim = trim
+        self.trim_margin = trim_margin
+        self.trim_threshold = trim_threshold
+        self.keep_alive = keep_alive
+        self.checkpoint = checkpoint
+        self.plate_heatmap = plate_heatmap
+        # None, or what to do about an anomalous well: 'flag' it in the
+        # outputs, 'skip' later commands that hit it, or 'stop' the batch
+        self.anomaly = anomaly
+        # (min, max) ohms of a healthy well, for the energy check
+        self.load_band = load_band
+        self.bad_wells = set()
+        # 'flat' files everything as prefix[timestamp-]rXcY.*, 'sharded' as
+        # YYYY/MM/DD/<prefix name><shot id>/rXcY.* next to the prefix
+        self.layout = layout
+        self.day = None
+        # with aggregate every well's traces are folded into a WaveformAggregate
+        # per (row, col, voltage, time), written out by write_aggregates()
+        self.aggregate = aggregate
+        self.aggregates = {}
+        # also write each well as a zappypyramid file, for viewers
+        self.pyramid = pyramid
+        # with post_jobs the wells of a shot are converted on a pool of that
+        # many processes, which get the captures through shared memory
+        self.post_pool = None
+        if post_jobs and not dry_run:
+            # started first so the workers share it and see the segments as
+            # owned by this process, which frees them
+            resource_tracker.ensure_running()
+            self.post_pool = multiprocessing.Pool(post_jobs, _post_init, (self.post_settings(),))
+        self.tn = None
+
+    # the command line reports errors by exiting; library users get an exception
+    # that zap()/zap_inner() turn into an 'invalid' result
+    def fail(self, message):
+        print(message)
+        if self.exit_on_error:
+            exit(1)
+        raise ZappyError(message)
 
-    def zap_inner(self, command):
+    # validates a Zappy.zap command; returns (v, time, row, col, max_current, energy_cutoff)
+    # with time including the preamble and row/col zero-offset as the chassis wants them
+    def parse_command(self, command):
         voltage = command["voltage"].split(':')
         if voltage[1].lower() != 'volts':
-            print('Voltage units are not recognized')
-            exit(1)
+            self.fail('Voltage units are not recognized')
         v = float(voltage[0])
         if v > 1000.0 or v < 12.0:  # minimum voltage is 10 for now due to discharge thresholds
-            print('Voltage ' + v + ' out of range')
-            exit(1)
+            self.fail('Voltage ' + str(v) + ' out of range')
 
         duration = command["duration"].split(':')
         if duration[1].lower() != 'milliseconds':
-            print('Duration units are not recognized')
-            exit(1)
+            self.fail('Duration units are not recognized')
         time = float(duration[0])
         if time > 15.3 or time < 0.0:
-            print('Duration ' + 'ms out of range')
-            exit(1)
+            self.fail('Duration ' + 'ms out of range')
         else:
             time = time + 1.0  # there is a 1.0ms "pre-amble" in the dataset
 
@@ -56,20 +244,17 @@ class ZappyJSON():
             if 'row' in options:
                 row = int(options["row"])
                 if row < 1 or row > 5:
-                    print("Row " + str(row) + " out of range")
-                    exit(1)
+                    self.fail("Row " + str(row) + " out of range")
                 row = row - 1  # actual row is zero-offset for zappy
             if 'col' in options:
                 col = int(options["col"])
                 if col < 1 or col > 13:
-                    print("Col " + str(col) + " out of range")
-                    exit(1)
+                    self.fail("Col " + str(col) + " out of range")
                 col = col - 1  # actual col is zero-offset for zappy
             if 'max_current' in options:
                 maxc = options["max_current"].split(':')
                 if maxc[1].lower() != 'amp' and maxc[1].lower() != 'amps':
-                    print("Units not recognized for max_current")
-                    exit(1)
+                    self.fail("Units not recognized for max_current")
                 max_current = float(maxc[0])
                 if max_current < 0.0:
                     if self.verbose:
@@ -77,13 +262,11 @@ class ZappyJSON():
             if 'energy_cutoff' in options:
                 ecut = options["energy_cutoff"].split(':')
                 if ecut[1].lower() != 'joules' and ecut[1].lower() != 'joule':
-                    print("Units not recognized for energy_cutoff")
-                    exit(1)
+                    self.fail("Units not recognized for energy_cutoff")
                 energy_cutoff_joules = float(ecut[0])
                 energy_cutoff = int(energy_cutoff_joules * ONEJOULE)
                 if energy_cutoff > 4294967295:
-                    print("Energy cutoff 32-bit integer overflow")
-                    exit(1)
+                    self.fail("Energy cutoff 32-bit integer overflow")
                 if self.verbose:
                     print("Setting cutoff of " + str(energy_cutoff) + " counts")
 
@@ -94,136 +277,216 @@ class ZappyJSON():
             print("Warning: no col specified, defaulting to all columns")
             col = 12
 
+        return v, time, row, col, max_current, energy_cutoff
+
+    # batch_row is the 1-based position of the command in its input file, if any,
+    # so outputs can be traced back to it after the batch has been reordered
+    def zap_inner(self, command, batch_row=None):
+        start = monotonic()
+        result = ZapResult('Zappy.zap', batch_row=batch_row)
+        try:
+            v, time, row, col, max_current, energy_cutoff = self.parse_command(command)
+        except (ZappyError, KeyError, IndexError, ValueError) as e:
+            if self.exit_on_error and not isinstance(e, ZappyError):
+                raise
+            result.status = 'invalid'
+            result.message = str(e)
+            return result
+
+        result.parameters = {
+            'voltage': v,
+            'duration': time - 1.0,
+            'row': row + 1,
+            'col': col + 1,
+            'max_current': max_current,
+            'energy_cutoff': energy_cutoff / ONEJOULE,
+            'energy_cutoff_counts': energy_cutoff,
+        }
+
+        if self.bad_wells & set(covered_wells(row + 1, col + 1)):
+            print('Skipping command for r' + str(row + 1) + 'c' + str(col + 1) + ', it hits a well flagged as anomalous')
+            result.status = 'skipped'
+            result.message = 'hits an anomalous well'
+            self.log_shot(result)
+            return result
+
         if self.dry_run or self.verbose:
             print('Parsing successful: voltage ' + str(v) + ' duration ' + str(time) + ' row ' + str(
                 row + 1) + ' col ' + str(col + 1) + ' max_current ' + str(max_current) + ' energy_cutoff ' + str(
                 energy_cutoff))
             if self.dry_run:
-                return
+                result.status = 'dry_run'
+                return result
+
+        result.timings['parse_ms'] = (monotonic() - start) * 1000
+        zapstr = str('zap ' + str(row) + ' ' + str(col) + ' ' + str(v) + ' ' + str(time * 1000) + ' ' + str(
+            max_current * 1000) + ' ' + str(energy_cutoff) + '\n\r')
+        start = monotonic()
+        result.status = self.send_command(zapstr, 'Zappy.zap')
+        result.timings['chassis_ms'] = (monotonic() - start) * 1000
+        # checkpoint before the slow conversion, so a crash during it can't
+        # get the shot fired again on --resume
+        if result.status == 'zpass' and self.checkpoint is not None and batch_row is not None:
+            self.checkpoint.record(batch_row, self.target_ip)
+
+        if result.status == 'zpass':
+            start = monotonic()
+            try:
+                result.wells = self.dump_csv(row + 1, col + 1, v, time, self.log_dir, batch_row, energy_cutoff)
+            except Exception as e:
+                print(e)
+                print('Error converting zappy logs')
+                result.message = str(e)
+            result.timings['dump_ms'] = (monotonic() - start) * 1000
+
+            flagged = [well for well in result.wells if well.anomalies]
+            for well in flagged:
+                print('Anomaly in r' + str(well.row) + 'c' + str(well.col) + ': ' + '; '.join(well.anomalies))
+            if flagged and self.anomaly == 'stop':
+                result.status = 'anomaly'
+                result.message = 'anomaly in ' + ', '.join('r' + str(well.row) + 'c' + str(well.col) for well in flagged)
+            elif self.anomaly == 'skip':
+                self.bad_wells.update((well.row, well.col) for well in flagged)
+
+        self.log_shot(result)
+        if (result.status == 'zerr' or result.status == 'timeout' or result.status == 'lost' or
+                result.status == 'anomaly') and self.exit_on_error:
+            exit(1)
+        return result
+
+    # the telnet session to the chassis; a new one per command unless keep_alive
+    # is set, in which case it stays open and is only re-dialled once the
+    # chassis has hung up
+    def session(self):
+        if self.tn is not None:
+            try:
+                if self.tn.sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b'':
+                    self.close_session()
+            except BlockingIOError:
+                pass
+            except OSError:
+                self.close_session()
+        if self.tn is None:
+            self.tn = zappytelnetlib.Telnet(self.target_ip)
+        return self.tn
+
+    # hang up; send_command does this after every command unless keep_alive
+    def close_session(self):
+        if self.tn is not None:
+            self.tn.close()
+            self.tn = None
+
+    # done with this ZappyJSON: hang up and shut the post_pool workers down
+    def close(self):
+        self.close_session()
+        if self.post_pool is not None:
+            self.post_pool.terminate()
+            self.post_pool.join()
+            self.post_pool = None
 
+    # sends one command line to the chassis and waits for its status; returns
+    # 'zpass', 'zerr', 'timeout', 'error' (could not talk to the chassis, the
+    # command was never sent) or 'lost' (sent, but no status came back)
+    def send_command(self, zapstr, name):
+        sent = False
         try:
-            tn = zappytelnetlib.Telnet(self.target_ip)
-            zapstr = str('zap ' + str(row) + ' ' + str(col) + ' ' + str(v) + ' ' + str(time * 1000) + ' ' + str(
-                max_current * 1000) + ' ' + str(energy_cutoff) + '\n\r')
+            tn = self.session()
             if self.verbose:
                 print('telnet> ' + zapstr)
             zapbytes = bytearray(zapstr, 'utf-8')
             tn.write(bytes(zapbytes))
+            sent = True
 
             try:
                 ret = tn.expect(["zerr", "zpass"], timeout=10)
                 # this requires editing telnetlib.py expect function: dm = list[i].search(self.cookedq.decode('utf-8'))
             except EOFError:
-                print('Zappy.zap failed: no status return')
+                print(name + ' failed: no status return')
+                self.close_session()
+                return 'lost'
             if ret[0] == -1:
-                print('Zappy.zap failed: status return timeout')
+                print(name + ' failed: status return timeout')
+                # a late status would be read as the next command's
+                self.close_session()
 
             if self.verbose and ret[0] != -1:
                 print('DEBUG: ' + ret[2].decode('utf-8'))
 
+            if not self.keep_alive:
+                self.close_session()
             if ret[2].decode('utf-8').find('zpass') != -1:
-                tn.close()
-                self.dump_csv(row + 1, col + 1, v, time)
-                return
+                return 'zpass'
             else:
                 print('Chassis returned error')
                 print(ret[2].decode('utf-8'))
-                tn.close()
-                exit(1)
+                if ret[0] == -1:
+                    return 'timeout'
+                return 'zerr'
 
         except Exception as e:
             print(e)
             print('Error sending command to zappy logic module')
+            self.close_session()
+            return 'lost' if sent else 'error'
+
+    def log_shot(self, result):
+        if self.ledger is None:
+            return
+        shot = dict(result.parameters)
+        shot.update(result.timings)
+        shot['name'] = result.name
+        shot['status'] = result.status
+        shot['chassis'] = self.target_ip
+        shot['batch_row'] = result.batch_row
+        shot['wells'] = [well.summary() for well in result.wells]
+        self.ledger.record(shot)
 
     def zap(self, json_string):
         self.json_string = json_string
 
         try:
-            command = json.loads(self.json_string)
-        except Exception as e:
-            print(e)
-            print('JSON grammar error decoding input string')
-            exit(1)
+            try:
+                command = json.loads(self.json_string)
+            except Exception as e:
+                print(e)
+                self.fail('JSON grammar error decoding input string')
 
-        try:
-            if(command["name"] == 'Zappy.zap'):
-                self.zap_inner(command)
+            try:
+                if(command["name"] == 'Zappy.zap'):
+                    return self.zap_inner(command)
 
-            elif(command["name"] == 'Zappy.lock'):
-                if self.dry_run:
-                    print('Dry run got lock command')
-                else:
-                    try:
-                        tn = zappytelnetlib.Telnet(self.target_ip)
-                        zapstr = str('plate lock\n\r')
-                        if self.verbose:
-                            print('telnet> ' + zapstr)
-                        zapbytes = bytearray(zapstr, 'utf-8')
-                        tn.write(bytes(zapbytes))
-                        try:
-                            ret = tn.expect(["zerr", "zpass"], timeout=10)
-                            # this requires editing telnetlib.py expect function: dm = list[i].search(self.cookedq.decode('utf-8'))
-                        except EOFError:
-                            print('Zappy.lock failed: no status return')
-                        if ret[0] == -1:
-                            print('Zappy.lock failed: status return timeout')
-
-                        if self.verbose and ret[0] != -1:
-                            print('DEBUG: ' + ret[2].decode('utf-8'))
-
-                        if ret[2].decode('utf-8').find('zpass') != -1:
-                            tn.close()
-                            exit(0)
-                        else:
-                            print('Chassis returned error')
-                            print(ret[2].decode('utf-8'))
-                            tn.close()
-                            exit(1)
-
-                    except Exception as e:
-                        print(e)
-                        print('Error sending command to zappy logic module')
-
-            elif(command["name"] == 'Zappy.unlock'):
-                if self.dry_run:
-                    print('Dry run got unlock command')
+                elif(command["name"] == 'Zappy.lock'):
+                    return self.plate_command('lock')
+
+                elif(command["name"] == 'Zappy.unlock'):
+                    return self.plate_command('unlock')
                 else:
-                    try:
-                        tn = zappytelnetlib.Telnet(self.target_ip)
-                        zapstr = str('plate unlock\n\r')
-                        if self.verbose:
-                            print('telnet> ' + zapstr)
-                        zapbytes = bytearray(zapstr, 'utf-8')
-                        tn.write(bytes(zapbytes))
-                        try:
-                            ret = tn.expect(["zerr", "zpass"], timeout=10)
-                            # this requires editing telnetlib.py expect function (line 620): m = list[i].search(self.cookedq.decode('utf-8'))
-                        except EOFError:
-                            print('Zappy.lock failed: no status return')
-                        if ret[0] == -1:
-                            print('Zappy.lock failed: status return timeout')
-
-                        if self.verbose and ret[0] != -1:
-                            print('DEBUG: ' + ret[2].decode('utf-8'))
-
-                        if ret[2].decode('utf-8').find('zpass') != -1:
-                            tn.close()
-                            exit(0)
-                        else:
-                            print('Chassis returned error')
-                            print(ret[2].decode('utf-8'))
-                            tn.close()
-                            exit(1)
-
-                    except Exception as e:
-                        print(e)
-                        print('Error sending command to zappy logic module')
-            else:
-                print("Command " + command["name"] + "not recognized")
+                    self.fail("Command " + command["name"] + "not recognized")
+            except KeyError:
+                self.fail("No 'name' field in JSON record, aborting")
+        except ZappyError as e:
+            result = ZapResult(None, 'invalid')
+            result.message = str(e)
+            return result
+
+    # action is 'lock' or 'unlock'
+    def plate_command(self, action):
+        result = ZapResult('Zappy.' + action)
+        if self.dry_run:
+            print('Dry run got ' + action + ' command')
+            result.status = 'dry_run'
+            return result
+
+        start = monotonic()
+        result.status = self.send_command(str('plate ' + action + '\n\r'), result.name)
+        result.timings['chassis_ms'] = (monotonic() - start) * 1000
+        self.log_shot(result)
+        if self.exit_on_error:
+            if result.status == 'zpass':
+                exit(0)
+            elif result.status != 'error':
                 exit(1)
-        except KeyError:
-            print("No 'name' field in JSON record, aborting")
-            exit(1)
+        return result
 
     def hex_to_signed(self, source):
         """Convert a string hex value to a signed hexadecimal value.
@@ -237,108 +500,1313 @@ class ZappyJSON():
         if not isinstance(source, str):
             raise ValueError("string type required")
         if 0 == len(source):
-            raise valueError("string is empty")
+            raise ValueError("string is empty")
         sign_bit_mask = 1 << (len(source) * 4 - 1)
         other_bits_mask = sign_bit_mask - 1
         value = int(source, 16)
         return -(value & sign_bit_mask) | (value & other_bits_mask)
 
     # row and col are 1-based numbering
-    def dump_csv(self, row, col, v, time):
+    def dump_csv(self, row, col, v, time, log_dir=LOG_DIR, batch_row=None, energy_cutoff=0):
+        if self.prefix is None and not self.keep_waveforms and self.anomaly is None and not self.aggregate:
+            return []
+
+        shot = None
+        if self.prefix is not None:
+            shot = self.new_shot(row, col, v, time, batch_row)
+
+        # a whole plate shot also gets one file with all 48 energies in it
+        counts = None
+        if row == 5 and col == 13:
+            counts, present = read_plate_energy(log_dir)
+            if self.prefix is not None:
+                self.dump_plate(counts, present, v, time, batch_row, shot)
+
+        wells = []
+        shared = []
+        try:
+            for r, c in covered_wells(row, col):
+                energycode = None
+                if counts is not None:
+                    # left blank in the plate matrix, and there's nothing to reopen
+                    if not present[r - 1, c - 1]:
+                        print('Skipping r' + str(r) + 'c' + str(c) + ', its energy file is missing or empty')
+                        continue
+                    energycode = int(counts[r - 1, c - 1])
+                if self.post_pool is not None and not self.keep_waveforms:
+                    shared.append(self.share_well(r, c, v, time, log_dir, batch_row=batch_row, energycode=energycode,
+                                                  energy_cutoff=energy_cutoff, shot=shot))
+                else:
+                    wells.append(self.dump_well(r, c, v, time, log_dir, batch_row=batch_row, energycode=energycode,
+                                                energy_cutoff=energy_cutoff, shot=shot))
+            for segment, job in shared:
+                well = job.get()
+                if self.aggregate:
+                    # the workers' sinks can't reach this process's aggregates,
+                    # but the capture is still right here
+                    codes = np.ndarray((well.samples, 2), dtype='<u2', buffer=segment.buf)
+                    aggregate = self.aggregate_for(well.row, well.col, v, time)
+                    for i in range(0, well.samples, CHUNK_SAMPLES):
+                        aggregate.add(well.offset + i, slow_volts(codes[i:i + CHUNK_SAMPLES, 0]),
+                                      fast_volts(codes[i:i + CHUNK_SAMPLES, 1]))
+                    aggregate.shots += 1
+                    del codes
+                wells.append(well)
+        finally:
+            # a segment is only freed once its worker is done with it, even
+            # when another well failed
+            for segment, job in shared:
+                job.wait()
+                segment.close()
+                segment.unlink()
+        return wells
+
+    # with the sharded layout, makes the directory one shot's outputs go in
+    # and adds it to that day's manifest; returns its path ending in a
+    # slash, or None with the flat layout.  source is the archive a
+    # reprocessed shot came from
+    def new_shot(self, row, col, v, time, batch_row=None, source=None):
+        if self.layout != 'sharded':
+            return None
+        now = datetime.now()
+        day = os.path.join(os.path.dirname(self.prefix), now.strftime('%Y/%m/%d'))
+        if day != self.day:
+            os.makedirs(day, exist_ok=True)
+            self.day = day
+        shot_id = os.path.basename(self.prefix) + now.strftime('%H_%M_%S.%f')[:-3]
+        path = os.path.join(day, shot_id)
+        n = 1
+        while True:
+            try:
+                os.mkdir(path)
+                break
+            except FileExistsError:
+                n += 1
+                path = os.path.join(day, shot_id + '-' + str(n))
+
+        with manifest_lock, open(os.path.join(day, 'manifest.csv'), 'a') as manifest:
+            if manifest.tell() == 0:
+                print("shot, time, row, col, target V, duration ms, batch row, source", file=manifest)
+            print(os.path.basename(path) + ', ' + now.isoformat(sep=' ', timespec='milliseconds') + ', ' + str(row) + ', ' +
+                  str(col) + ', ' + str(v) + ', ' + str(time - 1.0) + ', ' + ('' if batch_row is None else str(batch_row)) +
+                  ', ' + (source or ''), file=manifest)
+        return path + os.sep
+
+    # writes the plate matrix, and with plate_heatmap a heatmap PNG of it
+    def dump_plate(self, counts, present, v, time, batch_row=None, shot=None):
+        stamp = None
+        if self.serialize and shot is None:
+            stamp = datetime.now().strftime("%Y_%b_%d-%H_%M_%S.%f")[:-3]
+        joules = np.where(present, counts * ENERGY_COEFF, np.nan)
+        write_plate_matrix(self.out_path('plate.csv', stamp, shot), counts, present, joules, v, batch_row)
+        if self.plate_heatmap:
+            title = 'Zappy plate: target ' + str(v) + 'V / duration ' + str(time - 1.0) + 'ms / ' + '%.3f' % np.nansum(joules) + 'J total'
+            plate_heatmap(self.out_path('plate.png', stamp, shot), joules, title, self.fast_png)
+
+    # every output file name comes from here: name inside the shot directory
+    # with the sharded layout, else after the prefix and optional timestamp
+    def out_path(self, name, stamp=None, shot=None):
+        if shot is not None:
+            return shot + name
+        if stamp is not None:
+            return self.prefix + stamp + '-' + name
+        return self.prefix + name
+
+    def out_name(self, r, c, ext, stamp=None, shot=None):
+        return self.out_path('r' + str(r) + 'c' + str(c) + ext, stamp, shot)
+
+    # the consumers of a well's decoded capture, per the output settings
+    def well_sinks(self, r, c, v, time, stamp, batch_row, energy_cutoff=0, shot=None):
+        sinks = []
+        # first, so the other sinks see what it found when they finish
+        if self.anomaly is not None:
+            sinks.append(AnomalySink(v, time, energy_cutoff, self.load_band))
+        if self.prefix is not None:
+            sinks.append(CsvSink(self.out_name(r, c, '.csv', stamp, shot), v, batch_row, self.trim is not None))
+            if self.no_png == False:
+                sinks.append(PngSink(self.out_name(r, c, '.png', stamp, shot), v, time, self.fast_png))
+            if self.pyramid:
+                sinks.append(PyramidSink(self.out_name(r, c, '.pyr', stamp, shot)))
+        if self.keep_waveforms:
+            sinks.append(WaveformSink())
+        if self.aggregate:
+            sinks.append(AggregateSink(self.aggregate_for(r, c, v, time)))
+        return sinks
+
+    def aggregate_for(self, r, c, v, time):
+        key = (r, c, v, time)
+        if key not in self.aggregates:
+            self.aggregates[key] = WaveformAggregate()
+        return self.aggregates[key]
+
+    # one CSV per aggregated (row, col, voltage, time); returns their names
+    def write_aggregates(self):
+        names = []
         if self.prefix is None:
+            return names
+        for (r, c, v, time), aggregate in sorted(self.aggregates.items()):
+            name = self.out_path('aggregate-r' + str(r) + 'c' + str(c) + '-' + str(v) + 'V-' + str(time - 1.0) + 'ms.csv')
+            aggregate.write(name, "aggregate, row, " + str(r) + ", col, " + str(c) + ", target V, " + str(v) +
+                            ", duration ms, " + str(time - 1.0) + ", shots, " + str(aggregate.shots))
+            names.append(name)
+        return names
+
+    # converts the capture and energy files of a single well found in log_dir,
+    # streaming it chunk by chunk through the sinks; returns a WellResult
+    # energycode is the well's energy counts when the caller already read them,
+    # shot the directory from new_shot() with the sharded layout
+    def dump_well(self, r, c, v, time, log_dir=LOG_DIR, stamp=None, batch_row=None, energycode=None, energy_cutoff=0,
+                  shot=None):
+        well, log_name, stamp = self.open_well(r, c, time, log_dir, stamp, energycode, shot)
+        start = well.offset
+        stop = well.offset + well.samples
+        return self.convert_well(well, v, time, stamp, batch_row, energy_cutoff, shot,
+                                 lambda n: read_capture(log_name, n, start, stop))
+
+    # the WellResult of a well before conversion, with its energy read and
+    # the sample range to convert; also returns the capture path and stamp
+    def open_well(self, r, c, time, log_dir=LOG_DIR, stamp=None, energycode=None, shot=None):
+        log_name = log_dir + 'zappy-log.r' + str(r) + 'c' + str(c)
+        if energycode is None:
+            with open(log_dir + 'zappy-energy.r' + str(r) + 'c' + str(c), "r") as ef:
+                s = ef.read()
+                energycode = self.hex_to_signed(s.rstrip())
+
+        if stamp is None and self.serialize and shot is None:
+            now = datetime.now()
+            stamp = now.strftime("%Y_%b_%d-%H_%M_%S.%f")[:-3]
+
+        # a slow/fast sample pair is 4 bytes; a short last pair reads as zero padded
+        samples = (os.path.getsize(log_name) + 3) // 4
+        start, stop = self.trim_window(log_name, samples, time)
+        well = WellResult(r, c, energycode, stop - start)
+        well.offset = start
+        well.capture_samples = samples
+        return well, log_name, stamp
+
+    # streams a well through its sinks; chunks(n) yields its (slow, fast)
+    # codes n samples at a time
+    def convert_well(self, well, v, time, stamp, batch_row, energy_cutoff, shot, chunks):
+        sinks = self.well_sinks(well.row, well.col, v, time, stamp, batch_row, energy_cutoff, shot)
+        for sink in sinks:
+            sink.start(well)
+        # chunks must hold whole buckets of every sink for the bucket edges to line up
+        align = math.lcm(*[sink.align for sink in sinks], 1)
+        for slow, fast in chunks(max(1, CHUNK_SAMPLES // align) * align):
+            slowg = slow_volts(slow)
+            fastg = fast_volts(fast)
+            well.update(slowg, fastg)
+            for sink in sinks:
+                sink.add(slow, fast, slowg, fastg)
+        for sink in sinks:
+            sink.finish(well)
+        return well
+
+    # reads a well's capture straight into a shared memory segment and hands
+    # the post_pool a descriptor of it; returns the segment, which the caller
+    # frees once the job is done, and the job, whose result is the WellResult
+    def share_well(self, r, c, v, time, log_dir=LOG_DIR, stamp=None, batch_row=None, energycode=None, energy_cutoff=0,
+                   shot=None):
+        well, log_name, stamp = self.open_well(r, c, time, log_dir, stamp, energycode, shot)
+        segment = shared_memory.SharedMemory(create=True, size=max(well.samples * 4, 1))
+        try:
+            with open(log_name, 'rb') as f:
+                f.seek(well.offset * 4)
+                f.readinto(segment.buf[:well.samples * 4])
+            desc = {
+                'name': segment.name,
+                'shape': (well.samples, 2),
+                'dtype': '<u2',
+                'row': r,
+                'col': c,
+                'energy_counts': well.energy_counts,
+                'offset': well.offset,
+                'capture_samples': well.capture_samples,
+                'v': v,
+                'time': time,
+                'stamp': stamp,
+                'batch_row': batch_row,
+                'energy_cutoff': energy_cutoff,
+                'shot': shot,
+            }
+            job = self.post_pool.apply_async(_post_well, (desc,))
+        except BaseException:
+            segment.close()
+            segment.unlink()
+            raise
+        return segment, job
+
+    # what a post_pool worker needs to build the same sinks as this ZappyJSON
+    def post_settings(self):
+        return {
+            'verbose': self.verbose,
+            'prefix': self.prefix,
+            'no_png': self.no_png,
+            'fast_png': self.fast_png,
+            'trim': self.trim,
+            'anomaly': self.anomaly,
+            'load_band': self.load_band,
+            'pyramid': self.pyramid,
+        }
+
+    # the [start, stop) sample range of a capture to convert: everything, or
+    # with trim set the preamble plus pulse plus margin, either from the
+    # requested duration or from where the fast channel crosses the threshold
+    def trim_window(self, log_name, samples, time):
+        if self.trim is None:
+            return 0, samples
+        margin = int(self.trim_margin * SAMPLES_PER_MS)
+        # time includes the preamble the capture starts with
+        start = 0
+        stop = min(samples, int(time * SAMPLES_PER_MS) + margin)
+        if self.trim == 'detect':
+            first = None
+            last = None
+            offset = 0
+            for slow, fast in read_capture(log_name):
+                above = np.flatnonzero(fast_volts(fast) > self.trim_threshold)
+                if len(above):
+                    if first is None:
+                        first = offset + int(above[0])
+                    last = offset + int(above[-1])
+                offset = offset + len(fast)
+            # nothing crossed: fall back on the requested duration
+            if first is not None:
+                start = max(0, first - margin)
+                stop = min(samples, last + 1 + margin)
+        return start, stop
+
+
+def covered_wells(row, col):
+    """The (row, col) wells a command hits; row 5 and col 13 mean all of them, 1-based."""
+    rows = range(1, 5) if row == 5 else [row]
+    cols = range(1, 13) if col == 13 else [col]
+    return [(r, c) for r in rows for c in cols]
+
+
+def read_capture(path, chunk_samples=CHUNK_SAMPLES, start=0, stop=None):
+    """Yield the (slow, fast) raw codes of a zappy-log capture, chunk_samples at a time.
+
+    The capture is little-endian 16-bit slow/fast pairs; the arrays are views
+    into one read buffer, so memory use is bounded by the chunk size.  start
+    and stop limit it to a range of samples, which is seeked to directly.
+    """
+    with open(path, 'rb') as f:
+        f.seek(start * 4)
+        left = None if stop is None else stop - start
+        while left is None or left > 0:
+            n = chunk_samples if left is None else min(chunk_samples, left)
+            buf = f.read(n * 4)
+            if not buf:
+                return
+            if len(buf) % 4:
+                buf = buf + bytes(4 - len(buf) % 4)
+            codes = np.frombuffer(buf, dtype='<u2')
+            if left is not None:
+                left = left - len(codes) // 2
+            yield codes[0::2], codes[1::2]
+
+# hex digit values by ASCII code, 255 for anything else
+HEX_DIGITS = np.full(256, 255, dtype=np.uint8)
+for i, ch in enumerate('0123456789abcdef'):
+    HEX_DIGITS[ord(ch)] = i
+    HEX_DIGITS[ord(ch.upper())] = i
+
+
+def hex_to_signed_array(sources):
+    """ZappyJSON.hex_to_signed over an array of hex strings at once.
+
+    Each string is signed by its own length like hex_to_signed does; empty
+    strings come out as 0.
+    """
+    sources = np.asarray(sources, dtype='S')
+    width = sources.dtype.itemsize
+    lengths = np.char.str_len(sources).astype(np.int64)
+    chars = np.frombuffer(sources.tobytes(), dtype=np.uint8).reshape(sources.shape + (width,))
+    nibbles = HEX_DIGITS[chars].astype(np.int64)
+    # fixed width byte strings are NUL padded on the right
+    digit = np.arange(width) < lengths[..., None]
+    if np.any(nibbles[digit] == 255):
+        raise ValueError("hex string required")
+    nibbles[~digit] = 0
+    shifts = np.maximum(4 * (lengths[..., None] - 1 - np.arange(width)), 0)
+    value = (nibbles << shifts).sum(axis=-1)
+    sign_bit = np.where(lengths > 0, np.int64(1) << np.maximum(lengths * 4 - 1, 0), 0)
+    return np.where(value & sign_bit, value - 2 * sign_bit, value)
+
+
+def read_plate_energy(log_dir):
+    """Energy counts of all 48 wells in log_dir as a 4x12 array.
+
+    Also returns a mask of the wells that had an energy file with something
+    in it; the others read as 0.
+    """
+    text = []
+    for r in range(1, 5):
+        for c in range(1, 13):
+            try:
+                with open(log_dir + 'zappy-energy.r' + str(r) + 'c' + str(c), 'rb') as ef:
+                    text.append(ef.read().strip())
+            except FileNotFoundError:
+                text.append(b'')
+    sources = np.array(text, dtype='S').reshape(4, 12)
+    return hex_to_signed_array(sources), np.char.str_len(sources) > 0
+
+
+def write_plate_matrix(path, counts, present, joules, v, batch_row=None):
+    with open(path, 'w') as outf:
+        if batch_row is None:
+            print("plate, target V, " + str(v), file=outf)
+        else:
+            print("plate, target V, " + str(v) + ", batch row, " + str(batch_row), file=outf)
+        print("energy J, " + ', '.join('c' + str(c) for c in range(1, 13)), file=outf)
+        for r in range(4):
+            print('r' + str(r + 1) + ', ' + ', '.join('%.6f' % joules[r, c] if present[r, c] else '' for c in range(12)), file=outf)
+        print("energy counts, " + ', '.join('c' + str(c) for c in range(1, 13)), file=outf)
+        for r in range(4):
+            print('r' + str(r + 1) + ', ' + ', '.join(str(counts[r, c]) if present[r, c] else '' for c in range(12)), file=outf)
+
+
+def plate_heatmap(path, joules, title, fast_png=False):
+    if fast_png:
+        zappyraster.render_heatmap(path, joules, title)
+        return
+    import matplotlib.pyplot as plt
+    with plot_lock:
+        plt.imshow(np.ma.masked_invalid(joules), cmap='viridis')
+        plt.colorbar(label='energy J', shrink=0.6)
+        for r in range(4):
+            for c in range(12):
+                if not np.isnan(joules[r, c]):
+                    plt.text(c, r, '%.2f' % joules[r, c], ha='center', va='center', fontsize=6, color='w')
+        plt.xticks(range(12), [str(c) for c in range(1, 13)])
+        plt.yticks(range(4), ['r' + str(r) for r in range(1, 5)])
+        plt.title(title, fontsize=8)
+        plt.savefig(path, dpi=300, bbox_inches='tight')
+        plt.clf()
+
+
+def slow_volts(codes):
+    return (codes * (P5V_ADC / 4096) - P5V_ADC / 8192) * SLOW_M + SLOW_B
+
+def fast_volts(codes):
+    return (codes * (P5V_ADC / 4096) - P5V_ADC / 8192) * FAST_M + FAST_B
+
+
+class WaveformAggregate():
+    """Per-sample running mean and variance (Welford) and extremes of both
+    traces over repeated shots.
+
+    Memory is a few arrays as long as the longest capture added, however
+    many shots go in.  Samples are indexed from the start of the capture, so
+    trimmed shots line up with untrimmed ones.
+    """
+    def __init__(self):
+        self.shots = 0
+        self.n = np.zeros(0, dtype=np.int32)
+        # mean, sum of squared deviations, min and max, per trace
+        self.slow = self.empty(0)
+        self.fast = self.empty(0)
+
+    def empty(self, size):
+        return [np.zeros(size), np.zeros(size), np.full(size, np.inf, dtype=np.float32), np.full(size, -np.inf, dtype=np.float32)]
+
+    def grow(self, size):
+        more = size - len(self.n)
+        self.n = np.concatenate([self.n, np.zeros(more, dtype=np.int32)])
+        self.slow = [np.concatenate(pair) for pair in zip(self.slow, self.empty(more))]
+        self.fast = [np.concatenate(pair) for pair in zip(self.fast, self.empty(more))]
+
+    def add(self, start, slowg, fastg):
+        stop = start + len(slowg)
+        if stop > len(self.n):
+            self.grow(stop)
+        n = self.n[start:stop]
+        n += 1
+        for stats, x in ((self.slow, slowg), (self.fast, fastg)):
+            mean, m2, lo, hi = [a[start:stop] for a in stats]
+            delta = x - mean
+            mean += delta / n
+            m2 += delta * (x - mean)
+            np.minimum(lo, x, out=lo, casting='unsafe')
+            np.maximum(hi, x, out=hi, casting='unsafe')
+
+    def write(self, path, header):
+        keep = np.flatnonzero(self.n)
+        n = self.n[keep]
+        columns = [keep, n]
+        for mean, m2, lo, hi in (self.slow, self.fast):
+            std = np.sqrt(np.where(n > 1, m2[keep] / np.maximum(n - 1, 1), 0.0))
+            columns += [mean[keep], std, lo[keep], hi[keep]]
+        with open(path, 'w') as outf:
+            print(header, file=outf)
+            print("sample, shots, slow mean V, slow std V, slow min V, slow max V, fast mean V, fast std V, fast min V, fast max V", file=outf)
+            np.savetxt(outf, np.column_stack(columns), fmt=['%d', '%d'] + ['%.6g'] * 8, delimiter=', ')
+
+
+class WaveformEnvelope():
+    """Min/max decimation of the slow and fast traces for plotting, built chunk by chunk.
+
+    Captures of up to 2 * points samples are kept whole; longer ones are cut
+    into at most points buckets and each contributes its min and max, which
+    draws the same outline as the full trace at PNG resolution.  The bucket
+    is rounded up to a power of two below PLOT_ALIGN and to a multiple of it
+    above, so chunks that line up with it and with the pyramid levels stay
+    CHUNK_SAMPLES long however long the capture is.
+    """
+    def __init__(self, samples, points=PLOT_POINTS, offset=0):
+        self.bucket = 1 if samples <= 2 * points else -(-samples // points)
+        if self.bucket >= PLOT_ALIGN:
+            self.bucket = -(-self.bucket // PLOT_ALIGN) * PLOT_ALIGN
+        elif self.bucket > 1:
+            self.bucket = 1 << (self.bucket - 1).bit_length()
+        # sample index of the first point, for trimmed captures
+        self.offset = offset
+        self.t = []
+        self.slow = []
+        self.fast = []
+
+    def add(self, slowg, fastg):
+        n = len(slowg)
+        if self.bucket == 1:
+            self.t.append(np.arange(self.offset, self.offset + n))
+            self.slow.append(slowg.copy())
+            self.fast.append(fastg.copy())
+        else:
+            starts = np.arange(0, n, self.bucket)
+            self.t.append(np.repeat(starts + self.offset, 2) + np.tile([0, self.bucket // 2], len(starts)))
+            for trace, g in ((self.slow, slowg), (self.fast, fastg)):
+                pair = np.empty(2 * len(starts))
+                pair[0::2] = np.minimum.reduceat(g, starts)
+                pair[1::2] = np.maximum.reduceat(g, starts)
+                trace.append(pair)
+        self.offset = self.offset + n
+
+    def traces(self):
+        if not self.t:
+            return np.zeros(0), np.zeros(0), np.zeros(0)
+        return np.concatenate(self.t), np.concatenate(self.slow), np.concatenate(self.fast)
+
+
+class WellSink():
+    """Consumer of one well's capture, fed by ZappyJSON.dump_well().
+
+    start() gets the WellResult before any data, add() every chunk as raw
+    codes and volts, finish() the WellResult with its extremes filled in.
+    Chunks are a multiple of align samples, except the last.
+    """
+    align = 1
+
+    def start(self, well):
+        pass
+
+    def add(self, slow, fast, slowg, fastg):
+        pass
+
+    def finish(self, well):
+        pass
+
+
+class CsvSink(WellSink):
+    def __init__(self, path, v, batch_row=None, trim=False):
+        self.path = path
+        self.v = v
+        self.batch_row = batch_row
+        self.trim = trim
+        self.outf = None
+
+    def start(self, well):
+        self.outf = open(self.path, 'w+')
+        outf = self.outf
+        print("warning: using hard-coded calibration parameters from zappy-01", file=outf)
+        print("measured energy, " + str(well.energy_counts) + ", counts, " + str(well.energy_joules) + ", joules", file=outf)
+        if self.batch_row is None:
+            print("row, " + str(well.row) + ", col, " + str(well.col) + ", target V, " + str(self.v), file=outf)
+        else:
+            print("row, " + str(well.row) + ", col, " + str(well.col) + ", target V, " + str(self.v) + ", batch row, " + str(self.batch_row), file=outf)
+        if self.trim:
+            # the first line below is this many microseconds into the capture
+            print("trimmed, " + str(well.offset) + ", first sample, " + str(well.offset + well.samples) + ", end sample, " + str(well.capture_samples) + ", capture samples", file=outf)
+        print("slow V, fast V, slow code, fast code", file=outf)
+
+    def add(self, slow, fast, slowg, fastg):
+        self.outf.writelines(str(sv) + ', ' + str(fv) + ', ' + str(sc) + ', ' + str(fc) + '\n'
+                             for sv, fv, sc, fc in zip(slowg.tolist(), fastg.tolist(), slow.tolist(), fast.tolist()))
+
+    def finish(self, well):
+        self.outf.close()
+        well.csv = self.path
+
+
+class PngSink(WellSink):
+    def __init__(self, path, v, time, fast_png=False):
+        self.path = path
+        self.v = v
+        self.time = time
+        self.fast_png = fast_png
+        self.envelope = None
+
+    def start(self, well):
+        self.envelope = WaveformEnvelope(well.samples, offset=well.offset)
+        self.align = self.envelope.bucket
+
+    def add(self, slow, fast, slowg, fastg):
+        self.envelope.add(slowg, fastg)
+
+    def finish(self, well):
+        r = well.row
+        c = well.col
+        v = self.v
+        time = self.time
+        t, slowg, fastg = self.envelope.traces()
+        axismax = max(well.slow_max or 0.0, well.fast_max or 0.0)
+        flag = ''
+        if well.anomalies:
+            flag = ' / ANOMALY: ' + '; '.join(well.anomalies)
+        if self.fast_png:
+            zappyraster.render_waveform(self.path, t, [(fastg, zappyraster.BLUE, 'on cell'), (slowg, zappyraster.RED, 'at cap')], axismax,
+                                        'Zappy: row ' + str(r) + ' / col ' + str(c) + ' / target ' + str(v) + 'V / duration ' + str(time - 1.0) + 'ms + 1.0ms preamble / ' + '%.3f' % well.energy_joules + 'J / calparams: zappy-01' + flag)
+        else:
+            # only loaded when needed, importing it takes longer than drawing a raster thumbnail
+            import matplotlib.pyplot as plt
+            # pyplot keeps one global figure, so chassis threads take turns
+            with plot_lock:
+                plt.plot(t, fastg, 'b', label='on cell', alpha=0.5)
+                plt.plot(t, slowg, 'r', label='at cap', alpha=0.5)
+                plt.ylim(0, axismax)
+                plt.title('Zappy: row ' + str(r) + ' / col ' + str(c) + '/ target ' + str(v) + 'V / duration ' + str(time - 1.0) + 'ms + 1.0ms preamble; ' + '%.3f' % well.energy_joules + 'J / ' + 'calparams: zappy-01' + flag, fontsize=8)
+                plt.xlabel('time us')
+                plt.ylabel('volts V')
+                plt.legend(loc='lower right')
+                plt.savefig(self.path, dpi=300)
+                plt.clf()
+        well.png = self.path
+
+
+class WaveformSink(WellSink):
+    """Keeps the raw codes on the WellResult, 2 bytes per sample per channel."""
+    def start(self, well):
+        self.offset = 0
+        well.slow_codes = np.empty(well.samples, dtype=np.uint16)
+        well.fast_codes = np.empty(well.samples, dtype=np.uint16)
+        self.well = well
+
+    def add(self, slow, fast, slowg, fastg):
+        n = len(slow)
+        self.well.slow_codes[self.offset:self.offset + n] = slow
+        self.well.fast_codes[self.offset:self.offset + n] = fast
+        self.offset = self.offset + n
+
+
+class PyramidSink(WellSink):
+    """Writes the capture as a zappypyramid file: raw codes plus 16x and 256x min/max."""
+    align = 256
+
+    def __init__(self, path):
+        self.path = path
+        self.writer = None
+
+    def start(self, well):
+        calibration = {'slow': [SLOW_M, SLOW_B], 'fast': [FAST_M, FAST_B], 'adc': P5V_ADC}
+        self.writer = PyramidWriter(self.path, well.samples, well.offset, calibration)
+
+    def add(self, slow, fast, slowg, fastg):
+        self.writer.add(slow, fast)
+
+    def finish(self, well):
+        self.writer.close()
+
+
+class AggregateSink(WellSink):
+    def __init__(self, aggregate):
+        self.aggregate = aggregate
+
+    def start(self, well):
+        self.index = well.offset
+
+    def add(self, slow, fast, slowg, fastg):
+        self.aggregate.add(self.index, slowg, fastg)
+        self.index = self.index + len(slow)
+
+    def finish(self, well):
+        self.aggregate.shots += 1
+
+
+class AnomalySink(WellSink):
+    """Flags an arc or a bad electrode while the capture streams past.
+
+    Inside the requested pulse, away from its ramps, it looks for the on cell
+    (fast) channel collapsing below COLLAPSE_RATIO of a charged cap, the mark
+    of an arc, and for the pulse ending early with no energy cutoff asked for,
+    which is the max current protection tripping.  With an energy cutoff the
+    pulse is expected to drop to off early, so that only counts as a
+    collapse if the on cell comes back afterwards or less than
+    CUTOFF_REACHED of the cutoff was delivered.  With a load_band of
+    (min, max) ohms it also checks the energy against what the requested
+    voltage and duration would put into such a load.  Findings end up in
+    well.anomalies.
+    """
+    def __init__(self, v, time, energy_cutoff=0, load_band=None):
+        self.v = v
+        self.time = time
+        self.energy_cutoff = energy_cutoff
+        self.load_band = load_band
+
+    def start(self, well):
+        self.index = well.offset
+        self.first = int((PREAMBLE_MS + ANOMALY_EDGE) * SAMPLES_PER_MS)
+        self.last = min(int((self.time - ANOMALY_EDGE) * SAMPLES_PER_MS), well.offset + well.samples)
+        self.collapse = None
+        self.pulse_end = None
+
+    def add(self, slow, fast, slowg, fastg):
+        start = self.index
+        self.index = self.index + len(slow)
+        lo = max(self.first - start, 0)
+        hi = min(self.last - start, len(slow))
+        if lo >= hi:
             return
+        slowg = slowg[lo:hi]
+        fastg = fastg[lo:hi]
+        if self.collapse is None:
+            collapsed = np.flatnonzero((slowg > CHARGED_RATIO * self.v) & (fastg < COLLAPSE_RATIO * slowg))
+            if len(collapsed):
+                self.collapse = start + lo + int(collapsed[0])
+        on = np.flatnonzero(fastg > PULSE_RATIO * self.v)
+        if len(on):
+            self.pulse_end = start + lo + int(on[-1]) + 1
+
+    def finish(self, well):
+        collapse = self.collapse is not None
+        if collapse and self.energy_cutoff:
+            collapse = ((self.pulse_end or 0) > self.collapse or
+                        well.energy_joules < CUTOFF_REACHED * self.energy_cutoff / ONEJOULE)
+        if collapse:
+            well.anomalies.append('collapse at ' + str(self.collapse) + 'us')
+        if self.energy_cutoff == 0 and self.first < self.last and (self.pulse_end or 0) < self.last:
+            well.anomalies.append('cut off at ' + str(self.pulse_end or self.first) + 'us')
+        if self.load_band is not None:
+            # energy into a resistive load is V^2 t / R
+            full = self.v * self.v * (self.time - PREAMBLE_MS) / 1000
+            low = full / self.load_band[1]
+            high = full / self.load_band[0]
+            if self.energy_cutoff:
+                cutoff = self.energy_cutoff / ONEJOULE
+                low = min(low, cutoff)
+                high = min(high, cutoff * (1 + ENERGY_OVERSHOOT))
+            if not low <= well.energy_joules <= high:
+                well.anomalies.append('energy ' + '%.3f' % well.energy_joules + 'J outside ' + '%.3f' % low + '-' + '%.3f' % high + 'J')
+
+
+class SweepRange():
+    """Inclusive start..stop range of floats, indexed without materializing it."""
+    def __init__(self, start, stop, step):
+        if step <= 0:
+            raise ValueError("step must be positive")
+        if stop < start:
+            raise ValueError("stop is below start")
+        self.start = start
+        self.step = step
+        # the small slack keeps stop itself in when step does not divide evenly in binary
+        self.count = int((stop - start) / step + 1e-9) + 1
+
+    def __len__(self):
+        return self.count
 
-        in_prefix = '/opt/zappy/zappy-log.'
-        energy_prefix = '/opt/zappy/zappy-energy.'
-        if row == 5:
-            rstart = 1
-            rstop = 5
+    def __getitem__(self, i):
+        if i < 0 or i >= self.count:
+            raise IndexError(i)
+        return round(self.start + i * self.step, 9)
+
+
+def sweep_axis(spec, key, default):
+    value = spec.get(key, default)
+    if value is None:
+        raise ValueError("'" + key + "' is required")
+    if isinstance(value, dict):
+        return SweepRange(float(value["start"]), float(value["stop"]), float(value["step"]))
+    if not isinstance(value, list):
+        value = [value]
+    if len(value) == 0:
+        raise ValueError("'" + key + "' is empty")
+    return value
+
+
+class ZappySweep():
+    """Parametric sweep expanded lazily into Zappy.zap commands.
+
+    The spec is a JSON object such as zap_sweep.json:
+
+        voltage, duration, energy_cutoff, max_current
+            a number, a list of numbers or {"start", "stop", "step"}, in
+            volts, milliseconds, joules and amps
+        rows, cols
+            the same, for the wells; or "wells": ["r1c1", "r2c4", ...]
+        repeats
+            shots per combination, fired back to back (default 1)
+        shuffle, seed
+            fire the combinations in a random order that is reproducible
+            from seed
+
+    Commands are built one at a time from their index, so memory use does not
+    depend on the size of the sweep.  Shuffling uses a keyed Feistel network
+    over the index space instead of a shuffled list for the same reason.
+    """
+    def __init__(self, spec):
+        self.voltage = sweep_axis(spec, 'voltage', None)
+        self.duration = sweep_axis(spec, 'duration', None)
+        self.energy_cutoff = sweep_axis(spec, 'energy_cutoff', 0)
+        self.max_current = sweep_axis(spec, 'max_current', 16.0)
+        if 'wells' in spec:
+            self.wells = []
+            for well in spec['wells']:
+                m = re.match(r'r(\d+)c(\d+)$', well.lower())
+                if m is None:
+                    raise ValueError("well " + well + " is not of the form rXcY")
+                self.wells.append((int(m.group(1)), int(m.group(2))))
         else:
-            rstart = row
-            rstop = row+1
+            self.wells = [(int(r), int(c)) for r in sweep_axis(spec, 'rows', 5) for c in sweep_axis(spec, 'cols', 13)]
+        self.repeats = int(spec.get('repeats', 1))
+        if self.repeats < 1:
+            raise ValueError("repeats must be at least 1")
+        self.shuffle = bool(spec.get('shuffle', False))
+        self.seed = int(spec.get('seed', 0))
+
+        self.axes = (self.wells, self.voltage, self.duration, self.energy_cutoff, self.max_current)
+        self.combinations = 1
+        for axis in self.axes:
+            self.combinations = self.combinations * len(axis)
+
+    def __len__(self):
+        return self.combinations * self.repeats
+
+    def command(self, well, voltage, duration, energy_cutoff, max_current):
+        return {
+            'voltage': str(voltage) + ':volts',
+            'duration': str(duration) + ':milliseconds',
+            'option': {
+                'row': str(well[0]),
+                'col': str(well[1]),
+                'max_current': str(max_current) + ':amps',
+                'energy_cutoff': str(energy_cutoff) + ':joules',
+            },
+        }
+
+    def corners(self):
+        """The two commands holding every parameter at its lowest and highest value."""
+        lo = [min(axis[0], axis[len(axis) - 1]) if isinstance(axis, SweepRange) else min(axis) for axis in self.axes[1:]]
+        hi = [max(axis[0], axis[len(axis) - 1]) if isinstance(axis, SweepRange) else max(axis) for axis in self.axes[1:]]
+        rows = [r for r, c in self.wells]
+        cols = [c for r, c in self.wells]
+        return (self.command((min(rows), min(cols)), *lo), self.command((max(rows), max(cols)), *hi))
+
+    def __getitem__(self, i):
+        if i < 0 or i >= len(self):
+            raise IndexError(i)
+        combo = i // self.repeats
+        if self.shuffle:
+            combo = self.permute(combo)
+        values = []
+        for axis in reversed(self.axes):
+            values.append(axis[combo % len(axis)])
+            combo = combo // len(axis)
+        values.reverse()
+        return self.command(*values)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    # bijection of range(self.combinations) onto itself: a 4 round Feistel
+    # network over the next even power of two, cycle-walking until the
+    # result lands back in range
+    def permute(self, i):
+        half = max(1, ((self.combinations - 1).bit_length() + 1) // 2)
+        mask = (1 << half) - 1
+        key = self.seed.to_bytes(8, 'little', signed=True)
+        while True:
+            left = i >> half
+            right = i & mask
+            for rnd in range(4):
+                h = hashlib.blake2b(right.to_bytes(8, 'little') + bytes([rnd]), digest_size=8, key=key)
+                left, right = right, left ^ (int.from_bytes(h.digest(), 'little') & mask)
+            i = (left << half) | right
+            if i < self.combinations:
+                return i
+
+
+# Pool workers each build their own ZappyJSON from the settings handed to the
+# initializer, so nothing but the small job tuples crosses the process boundary
+_reprocess_zappy = None
+
+def _reprocess_init(settings):
+    global _reprocess_zappy
+    _reprocess_zappy = ZappyJSON(**settings)
+
+def _reprocess_one(job):
+    log_dir, stamp, shot, r, c, v, time = job
+    try:
+        return (job, _reprocess_zappy.dump_well(r, c, v, time, log_dir, stamp, shot=shot).summary(), None)
+    except Exception as e:
+        return (job, None, str(e))
+
+# post_pool workers, like the reprocess ones, each build a ZappyJSON once and
+# get only descriptors of shared memory segments per well
+_post_zappy = None
+
+def _post_init(settings):
+    global _post_zappy
+    _post_zappy = ZappyJSON(**settings)
 
-        if col == 13:
-            cstart = 1
-            cstop = 13
+def _post_well(desc):
+    segment = shared_memory.SharedMemory(name=desc['name'])
+    try:
+        well = WellResult(desc['row'], desc['col'], desc['energy_counts'], desc['shape'][0])
+        well.offset = desc['offset']
+        well.capture_samples = desc['capture_samples']
+        codes = np.ndarray(desc['shape'], dtype=desc['dtype'], buffer=segment.buf)
+
+        def chunks(n):
+            for i in range(0, len(codes), n):
+                yield codes[i:i + n, 0], codes[i:i + n, 1]
+
+        _post_zappy.convert_well(well, desc['v'], desc['time'], desc['stamp'], desc['batch_row'],
+                                 desc['energy_cutoff'], desc['shot'], chunks)
+        # views into the segment have to be gone before it can be closed
+        del codes, chunks
+        return well
+    finally:
+        segment.close()
+
+def find_captures(source):
+    """Return (log_dir, row, col) for every archived zappy-log.rXcY under source.
+
+    source is either a directory holding the files copied out of /opt/zappy/
+    or a glob matching the capture files themselves.
+    """
+    if os.path.isdir(source):
+        paths = glob.glob(os.path.join(source, 'zappy-log.r*c*'))
+    else:
+        paths = glob.glob(source)
+
+    captures = []
+    for path in sorted(paths):
+        m = re.match(r'zappy-log\.r(\d+)c(\d+)$', os.path.basename(path))
+        if m is None:
+            continue
+        captures.append((os.path.dirname(path) + os.sep, int(m.group(1)), int(m.group(2))))
+    return captures
+
+def reprocess(source, v, time, prefix, no_png=False, serialize=False, jobs=None, verbose=False, fast_png=False,
+              trim=None, trim_margin=TRIM_MARGIN, trim_threshold=TRIM_THRESHOLD, anomaly=None, load_band=None,
+              layout='flat', pyramid=False):
+    """Regenerate CSV/PNG outputs for archived captures on a pool of workers.
+
+    time is the pulse duration in milliseconds including the 1.0ms preamble,
+    same as what zap_inner() hands to dump_csv().  A summary CSV with one line
+    per well is written next to the outputs.  Returns the number of failures.
+    """
+    captures = find_captures(source)
+    if len(captures) == 0:
+        print('No zappy-log captures found in ' + source)
+        return 1
+
+    Path(prefix).parent.mkdir(parents=True, exist_ok=True)
+    settings = {
+        'verbose': verbose,
+        'prefix': prefix,
+        'no_png': no_png,
+        'serialize': serialize,
+        'fast_png': fast_png,
+        'trim': trim,
+        'trim_margin': trim_margin,
+        'trim_threshold': trim_threshold,
+        'anomaly': anomaly,
+        'load_band': load_band,
+        'layout': layout,
+        'pyramid': pyramid,
+    }
+
+    # captures from several archive directories would overwrite each other's
+    # outputs, so tag them with the directory they came from; with the
+    # sharded layout each directory is a shot of its own instead
+    log_dirs = sorted(set(log_dir for log_dir, r, c in captures))
+    shots = {}
+    for log_dir in log_dirs:
+        wells = [(r, c) for d, r, c in captures if d == log_dir]
+        row, col = wells[0] if len(wells) == 1 else (5, 13)
+        shots[log_dir] = ZappyJSON(**settings).new_shot(row, col, v, time, source=log_dir)
+    work = []
+    for log_dir, r, c in captures:
+        stamp = os.path.basename(os.path.normpath(log_dir)) if len(log_dirs) > 1 else None
+        work.append((log_dir, stamp, shots[log_dir], r, c, v, time))
+
+    failures = 0
+    done = 0
+    summary_name = prefix + 'summary.csv'
+    with open(summary_name, 'w') as summary, \
+            multiprocessing.Pool(jobs, _reprocess_init, (settings,)) as pool:
+        print("source, row, col, energy counts, energy joules, samples, slow max V, fast max V, csv, png, anomalies, error", file=summary)
+        for job, well, err in pool.imap_unordered(_reprocess_one, work):
+            done += 1
+            log_dir, stamp, shot, r, c, v, time = job
+            where = log_dir + 'zappy-log.r' + str(r) + 'c' + str(c)
+            if err is not None:
+                failures += 1
+                print('[' + str(done) + '/' + str(len(work)) + '] ' + where + ' failed: ' + err)
+                print(log_dir + ', ' + str(r) + ', ' + str(c) + ', , , , , , , , , ' + err.replace(',', ';'), file=summary)
+                continue
+            if verbose:
+                print('[' + str(done) + '/' + str(len(work)) + '] ' + where + ' -> ' + well['csv'])
+            elif done % 10 == 0 or done == len(work):
+                print('[' + str(done) + '/' + str(len(work)) + '] reprocessed')
+            print(log_dir + ', ' + str(r) + ', ' + str(c) + ', ' + str(well['energy_counts']) + ', ' +
+                  str(well['energy_joules']) + ', ' + str(well['samples']) + ', ' + str(well['slow_max']) + ', ' +
+                  str(well['fast_max']) + ', ' + well['csv'] + ', ' + str(well['png'] or '') + ', ' +
+                  well['anomalies'].replace(',', ';') + ', ', file=summary)
+
+    print('Reprocessed ' + str(len(work) - failures) + ' of ' + str(len(work)) + ' wells, summary in ' + summary_name)
+    return failures
+
+
+# rough chassis timing model, in seconds, used to rank orderings of a batch.
+# These are ballpark defaults, not measurements of any chassis; pass the real
+# figures with --schedule-model
+SHOT_OVERHEAD = 1.5     # command round trip, capture readback and beep
+CHARGE_RATE = 250.0     # volts per second the cap charges up at
+DISCHARGE_RATE = 60.0   # volts per second it bleeds down at
+WELL_SWITCH = 0.25      # relay reconfiguration when the target well changes
+SCHEDULE_MODEL = (SHOT_OVERHEAD, CHARGE_RATE, DISCHARGE_RATE, WELL_SWITCH)
+
+def batch_cost(shots, v=0.0, well=None, model=SCHEDULE_MODEL):
+    """Estimated chassis wall time of firing shots in order.
+
+    shots are (v, time, row, col) tuples as returned by parse_command(); v and
+    well are the cap voltage and well the chassis starts from.  model is the
+    (shot overhead, charge rate, discharge rate, well switch) to cost them with.
+    """
+    overhead, charge_rate, discharge_rate, well_switch = model
+    cost = 0.0
+    for shot in shots:
+        if shot[0] > v:
+            cost = cost + (shot[0] - v) / charge_rate
         else:
-            cstart = col
-            cstop = col+1
-
-        slow = []
-        fast = []
-
-        # hard coded calibration parameters from zappy-01 for now
-        FAST_M=230.156015 #215.7720466
-        FAST_B=0.176922133 #-0.0488699
-        SLOW_M=229.9235716
-        SLOW_B=-0.008779325
-        P5V_ADC=5.009
-        for r in range(rstart, rstop):
-            for c in range(cstart, cstop):
-                with open(in_prefix + 'r' + str(r) + 'c' + str(c), "rb") as f:
-                    s = f.read(2)
-                    while s:
-                        slow.append(int.from_bytes(s, byteorder='little'))
-                        s = f.read(2)
-                        fast.append(int.from_bytes(s, byteorder='little'))
-                        s = f.read(2)
-
-                with open(energy_prefix + 'r' + str(r) + 'c' + str(c), "r") as ef:
-                    s = ef.read()
-                    energycode = self.hex_to_signed(s.rstrip())
-
-                if self.serialize:
-                    now = datetime.now()
-                    out_name = self.prefix + now.strftime("%Y_%b_%d-%H_%M_%S.%f")[:-3] + '-r' + str(r) + 'c' + str(c) + '.csv'
+            cost = cost + (v - shot[0]) / discharge_rate
+        if (shot[2], shot[3]) != well:
+            cost = cost + well_switch
+        cost = cost + overhead + shot[1] / 1000
+        v = shot[0]
+        well = (shot[2], shot[3])
+    return cost
+
+def schedule_batch(batch, shots, groups, model=SCHEDULE_MODEL):
+    """Reorder a validated batch to cut the estimated chassis wall time.
+
+    batch is a list of (batch_row, command), shots the matching parsed
+    (v, time, row, col) tuples and groups the matching constraint labels:
+    commands are only reordered within a run of consecutive rows sharing a
+    group, and the runs keep their place, so groups A, B, A stay three
+    blocks in that order.  Sorting is stable, so repeats of the same command
+    always keep their relative order.  model is passed on to
+    batch_cost().
+    """
+    blocks = []
+    for i in range(len(batch)):
+        if i > 0 and groups[i] == groups[i - 1]:
+            blocks[-1].append(i)
+        else:
+            blocks.append([i])
+
+    order = []
+    for block in blocks:
+        v = shots[order[-1]][0] if order else 0.0
+        well = (shots[order[-1]][2], shots[order[-1]][3]) if order else None
+        candidates = [
+            block,
+            # ascending voltage never waits on a discharge inside the block
+            sorted(block, key=lambda i: (shots[i][0], shots[i][2], shots[i][3])),
+            # or stay on each well and climb its voltages
+            sorted(block, key=lambda i: (shots[i][2], shots[i][3], shots[i][0])),
+        ]
+        order.extend(min(candidates, key=lambda c: batch_cost([shots[i] for i in c], v, well, model)))
+
+    return [batch[i] for i in order], batch_cost([shots[i] for i in order], model=model), batch_cost(shots, model=model)
+
+
+class BatchCheckpoint():
+    """Append-only journal of the batch rows a chassis has confirmed.
+
+    Each line is the hash of the input file, the 1-based batch row, the
+    chassis and the time, fsync'd as soon as the zpass comes back, so a batch
+    that died part way can be picked up with --resume without a shot being
+    repeated or lost.  Editing the input file changes its hash and starts
+    the batch afresh.
+    """
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self.lock = threading.Lock()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.f = open(path, 'a+')
+        # don't glue onto a line cut short by a crash
+        if self.f.tell() > 0:
+            self.f.seek(self.f.tell() - 1)
+            if self.f.read(1) != '\n':
+                self.f.write('\n')
+
+    # batch rows already done for this input file
+    def completed(self):
+        rows = set()
+        with open(self.path) as f:
+            for line in f:
+                fields = line.split(',')
+                if line.endswith('\n') and len(fields) == 4 and fields[0] == self.key:
+                    rows.add(int(fields[1]))
+        return rows
+
+    def record(self, batch_row, target_ip):
+        with self.lock:
+            self.f.write(self.key + ',' + str(batch_row) + ',' + target_ip + ',' +
+                         datetime.now().isoformat(sep=' ', timespec='milliseconds') + '\n')
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:16]
+
+
+def run_batch(zappies, batch, pins=(), total=None):
+    """Fire a batch of (batch_row, command) pairs; returns the number of failed shots.
+
+    With a single chassis the commands run in order and a chassis error stops
+    the batch through exit(), as always.  With several they are sharded by
+    ChassisShards.
+    """
+    try:
+        if len(zappies) == 1:
+            for batch_row, command in batch:
+                zappies[0].zap_inner(command, batch_row)
+            return 0
+        return ChassisShards(zappies, batch, pins, total).run()
+    finally:
+        # also when a chassis error exits part way, what was aggregated is kept
+        for zappy in zappies:
+            for name in zappy.write_aggregates():
+                print('Aggregate written to ' + name)
+            zappy.close()
+
+
+# commands a thread may park for a busy pinned chassis before the others
+# stop reading ahead in the batch and wait for it to catch up
+PINNED_BACKLOG = 16
+
+
+class ChassisShards():
+    """Work-stealing distribution of a batch over several chassis.
+
+    Every chassis runs on its own thread with its own ZappyJSON and pulls the
+    next command from the shared batch as soon as its previous shot is done,
+    so faster units simply take more of the work.  pins is a list of
+    (target_ip, row, col) with col None for a whole row: commands hitting
+    those wells only ever run on that chassis, and are parked on its own
+    queue when another thread pulls them.  The batch is only read as far as
+    needed, so lazy sweeps stay lazy, and reading stops while a pinned queue
+    holds PINNED_BACKLOG commands.  A chassis that can't be reached hands its
+    command back and drops out; the batch goes on while any chassis is left.
+    A command that was sent but got no status back ('lost') may have fired,
+    so it is never handed on: it fails and stops the batch like a timeout.
+    """
+    def __init__(self, zappies, batch, pins=(), total=None):
+        self.zappies = zappies
+        self.batch = iter(batch)
+        self.pins = pins
+        self.total = total
+        self.pinned = {}
+        for zappy in zappies:
+            self.pinned[zappy.target_ip] = collections.deque()
+        # jobs handed back by a chassis that dropped out
+        self.retry = collections.deque()
+        self.live = set(self.pinned)
+        self.retired = []
+        self.lock = threading.Condition()
+        self.exhausted = False
+        self.busy = 0
+        self.stop = False
+        self.done = 0
+        self.shots = {}
+        self.failed = []
+
+    # the chassis the wells a command hits are pinned to; a malformed row or
+    # col is left for zap_inner() to reject
+    def owners(self, command):
+        option = command.get('option', {})
+        try:
+            wells = covered_wells(int(option.get('row', 5)), int(option.get('col', 13)))
+        except (TypeError, ValueError):
+            return set()
+        owners = set()
+        for target_ip, pin_row, pin_col in self.pins:
+            for row, col in wells:
+                if pin_row == row and (pin_col is None or pin_col == col):
+                    owners.add(target_ip)
+        return owners
+
+    def next_job(self, target_ip):
+        with self.lock:
+            while not self.stop and target_ip in self.live:
+                if self.pinned[target_ip]:
+                    self.busy += 1
+                    self.lock.notify_all()
+                    return self.pinned[target_ip].popleft()
+                if self.retry:
+                    self.busy += 1
+                    return self.retry.popleft()
+                if self.exhausted:
+                    # a shot still in flight may yet be handed back
+                    if self.busy == 0:
+                        return None
+                    self.lock.wait()
+                    continue
+                if any(len(self.pinned[ip]) >= PINNED_BACKLOG for ip in self.live):
+                    self.lock.wait()
+                    continue
+
+                try:
+                    job = next(self.batch)
+                except StopIteration:
+                    self.exhausted = True
+                    continue
+                owners = self.owners(job[1])
+                if len(owners) > 1:
+                    print('Batch row ' + str(job[0]) + ' hits wells pinned to ' + ' and '.join(sorted(owners)))
+                    self.failed.append((target_ip, job[0], 'invalid'))
+                    self.stop = True
+                    self.lock.notify_all()
+                    return None
+                if not owners or target_ip in owners:
+                    self.busy += 1
+                    return job
+                owner = owners.pop()
+                if owner in self.live:
+                    self.pinned[owner].append(job)
+                    self.lock.notify_all()
+                else:
+                    self.failed.append((owner, job[0], 'error'))
+            return None
+
+    # drop a chassis that could not be talked to, handing its job to the
+    # others; what is pinned to it can't run anywhere else
+    def retire(self, target_ip, job):
+        print(target_ip + ' could not be reached, leaving the rest of the batch to the other chassis')
+        self.live.discard(target_ip)
+        self.retired.append(target_ip)
+        lost = list(self.pinned[target_ip])
+        self.pinned[target_ip].clear()
+        if target_ip in self.owners(job[1]):
+            lost.append(job)
+        else:
+            self.retry.append(job)
+        if not self.live:
+            lost.extend(self.retry)
+            self.retry.clear()
+            self.stop = True
+        for batch_row, command in lost:
+            self.failed.append((target_ip, batch_row, 'error'))
+        self.lock.notify_all()
+
+    def worker(self, zappy):
+        while True:
+            try:
+                job = self.next_job(zappy.target_ip)
+            except Exception as e:
+                # the batch itself is broken, e.g. a CSV missing a column
+                print(e)
+                print('Error reading the batch')
+                with self.lock:
+                    self.failed.append((zappy.target_ip, None, 'failed'))
+                    self.stop = True
+                    self.lock.notify_all()
+                return
+            if job is None:
+                return
+            batch_row, command = job
+            try:
+                status = zappy.zap_inner(command, batch_row).status
+            except SystemExit:
+                # a ZappyJSON left with exit_on_error set exits instead
+                status = 'failed'
+            except Exception as e:
+                print(e)
+                print('Error running batch row ' + str(batch_row))
+                status = 'failed'
+
+            with self.lock:
+                self.busy -= 1
+                self.lock.notify_all()
+                if status == 'error':
+                    self.retire(zappy.target_ip, job)
+                    return
+                if (status == 'zerr' or status == 'timeout' or status == 'lost' or status == 'invalid' or
+                        status == 'failed' or status == 'anomaly'):
+                    # like on a single chassis a chassis or validation error
+                    # ends the batch, here once the in-flight shots land
+                    self.stop = True
+
+                self.done += 1
+                self.shots[zappy.target_ip] = self.shots.get(zappy.target_ip, 0) + 1
+                if status != 'zpass' and status != 'dry_run':
+                    self.failed.append((zappy.target_ip, batch_row, status))
+                if self.total is None:
+                    progress = '[' + str(self.done) + '] '
                 else:
-                    out_name = self.prefix + 'r' + str(r) + 'c' + str(c) + '.csv'
-
-                slowg = []
-                fastg = []
-                with open(out_name, 'w+') as outf:
-                    print("warning: using hard-coded calibration parameters from zappy-01", file=outf)
-                    print("measured energy, " + str(energycode) + ", counts, " + str(energycode * ENERGY_COEFF) + ", joules", file=outf)
-                    print("row, " + str(r) + ", col, " + str(c) + ", target V, " + str(v), file=outf)
-                    print("slow V, fast V, slow code, fast code", file=outf)
-                    for i in range(len(slow)):
-                        slowv = (slow[i] * (P5V_ADC / 4096) - P5V_ADC / 8192) * SLOW_M + SLOW_B
-                        slowg.append(slowv)
-                        fastv = (fast[i] * (P5V_ADC / 4096) - P5V_ADC / 8192) * FAST_M + FAST_B
-                        fastg.append(fastv)
-                        print(str(slowv) + ', ' + str(fastv) + ', ' + str(slow[i]) + ', ' + str(fast[i]), file=outf)
-                    outf.close()
-
-                if self.no_png == False:
-                    t = range(len(slowg))
-                    axismax = max(slowg)
-                    if( axismax < max(fastg)):
-                        axismax = max(fastg)
-                    plt.plot(t, fastg, 'b', label='on cell', alpha=0.5)
-                    plt.plot(t, slowg, 'r', label='at cap', alpha=0.5)
-                    plt.ylim(0, axismax)
-                    plt.title('Zappy: row ' + str(r) + ' / col ' + str(c) + '/ target ' + str(v) + 'V / duration ' + str(time - 1.0) + 'ms + 1.0ms preamble; ' + '%.3f' % (energycode * ENERGY_COEFF) + 'J / ' + 'calparams: zappy-01', fontsize=8)
-                    plt.xlabel('time us')
-                    plt.ylabel('volts V')
-                    plt.legend(loc='lower right')
-                    if self.serialize:
-                        out_png = self.prefix + now.strftime("%Y_%b_%d-%H_%M_%S.%f")[:-3] + '-r' + str(r) + 'c' + str(c) + '.png'
-                    else:
-                        out_png = self.prefix + 'r' + str(r) + 'c' + str(c) + '.png'
-                    plt.savefig(out_png, dpi=300)
-                    plt.clf()
-
-                slow = []
-                fast = []
-                f.close()
+                    progress = '[' + str(self.done) + '/' + str(self.total) + '] '
+                print(progress + zappy.target_ip + ' batch row ' + str(batch_row) + ': ' + str(status))
+
+    def run(self):
+        threads = []
+        for zappy in self.zappies:
+            thread = threading.Thread(target=self.worker, args=(zappy,), name=zappy.target_ip)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
 
+        for zappy in self.zappies:
+            print(zappy.target_ip + ': ' + str(self.shots.get(zappy.target_ip, 0)) + ' shots' +
+                  (', dropped out' if zappy.target_ip in self.retired else ''))
+        for target_ip, batch_row, status in self.failed:
+            if batch_row is None:
+                print('Batch input on ' + target_ip + ' ' + status)
+            else:
+                print('Batch row ' + str(batch_row) + ' on ' + target_ip + ' ' + status)
+        if self.stop:
+            print('Batch stopped after an error')
+        return len(self.failed) + len(self.retired)
 
 
+def csv_commands(reader):
+    for row in reader:
+        command = {}
+        command['voltage'] = str(row['voltage']) + ':volts'
+        command['duration'] = str(row['duration']) + ':milliseconds'
+        option={}
+        option['row'] = str(row['row'])
+        option['col'] = str(row['col'])
+        option['max_current'] = str(row['max_current']) + ':amps'
+        option['energy_cutoff'] = str(row['energy_cutoff']) + ':joules'
+        command['option'] = option
+        yield command
 
 
 def main():
     parser = argparse.ArgumentParser(description="Zappy JSON command line interface")
     parser.add_argument(
-        "-t", "--target", help="IP address of zappy logic board", default="10.0.11.2"
+        "-t", "--target", help="IP address of zappy logic board; a comma separated list shards a --csv or --sweep batch across several chassis, with IP=DIR for a chassis whose captures are not in " + LOG_DIR, default="10.0.11.2"
+    )
+    parser.add_argument(
+        "--pin", help="Only run a row (IP=rX) or well (IP=rXcY) on the given chassis; can be repeated", action='append', default=[]
     )
     filetype = parser.add_mutually_exclusive_group(required=True)
     filetype.add_argument(
@@ -347,6 +1815,15 @@ def main():
     filetype.add_argument(
         "-c", "--csv", help="Filename of CSV command file"
     )
+    filetype.add_argument(
+        "-w", "--sweep", help="Filename of JSON sweep spec, expanded into a batch of zap commands"
+    )
+    filetype.add_argument(
+        "-r", "--reprocess", help="Directory or glob of archived zappy-log/zappy-energy files to regenerate CSV and PNG from"
+    )
+    filetype.add_argument(
+        "--watch", help="Spool directory to watch for JSON command files, fired in name order over one telnet session; see zappyspool.py"
+    )
     parser.add_argument(
         "-d", "--dry-run", help="Dry run to check input formatting", dest='dry_run', action='store_true'
     )
@@ -359,21 +1836,154 @@ def main():
     parser.add_argument(
         "-n", "--no-png", help="Don't save PNG graph when output prefix is specified to speedup data post-processing", dest='no_png', action='store_true'
     )
+    parser.add_argument(
+        "--fast-png", help="Draw PNGs with the built-in rasterizer instead of matplotlib, for quick-look thumbnails", dest='fast_png', action='store_true'
+    )
+    parser.add_argument(
+        "--pyramid", help="Also write each well as a .pyr waveform pyramid (1x, 16x and 256x min/max) for fast zooming viewers, see zappypyramid.py", action='store_true'
+    )
+    parser.add_argument(
+        "--plate-heatmap", help="Also draw a heatmap PNG of the plate energies for whole plate shots", dest='plate_heatmap', action='store_true'
+    )
+    parser.add_argument(
+        "--anomaly", help="What to do when a capture looks like an arc, a max current trip or an energy outside --load-band: nothing (default, the checks are still being tuned against real captures), flag it in the outputs, skip later commands hitting that well, or stop the batch", choices=['off', 'flag', 'skip', 'stop'], default='off'
+    )
+    parser.add_argument(
+        "--load-band", help="MIN:MAX ohms of a healthy well; the energy of each well is checked against what the voltage and duration put into such a load", dest='load_band'
+    )
+    parser.add_argument(
+        "--trim", help="Only convert the preamble, pulse and a margin of each capture; the pulse end comes from the requested duration or is detected on the fast channel", choices=['duration', 'detect']
+    )
+    parser.add_argument(
+        "--trim-margin", help="Milliseconds kept around the pulse with --trim (default " + str(TRIM_MARGIN) + ")", dest='trim_margin', type=float, default=TRIM_MARGIN
+    )
+    parser.add_argument(
+        "--trim-threshold", help="Fast channel volts that count as pulse with --trim detect (default " + str(TRIM_THRESHOLD) + ")", dest='trim_threshold', type=float, default=TRIM_THRESHOLD
+    )
     parser.add_argument(
         "-s", "--serialize", help="Add timestamps to filename when saving CSV and PNG", dest='serialize', action='store_true'
     )
+    parser.add_argument(
+        "--layout", help="flat puts every output file next to the prefix; sharded files each shot in a YYYY/MM/DD/<shot id>/ directory next to it, listed in a manifest.csv per day", choices=['flat', 'sharded'], default='flat'
+    )
+    parser.add_argument(
+        "-o", "--schedule", help="Reorder a --csv batch to minimize chassis recharge and well switching time; rows only move among neighbouring rows with the same 'group' column value", dest='schedule', action='store_true'
+    )
+    parser.add_argument(
+        "--schedule-model", help="OVERHEAD:CHARGE:DISCHARGE:SWITCH timing model --schedule ranks orderings with: seconds per shot, volts per second the cap charges and discharges at, and seconds per well change (default " +
+        ':'.join(str(x) for x in SCHEDULE_MODEL) + ", rough guesses)", dest='schedule_model'
+    )
+    parser.add_argument(
+        "--resume", help="Skip the rows of a --csv batch that the checkpoint journal says already passed", action='store_true'
+    )
+    parser.add_argument(
+        "--checkpoint", help="Journal of the --csv batch rows that passed, for --resume", default=str(Path.home()) + "/zap-logs/checkpoint.csv"
+    )
+    parser.add_argument(
+        "--post-jobs", help="Convert and plot the wells of each shot on this many worker processes, handed the captures through shared memory", dest='post_jobs', type=int
+    )
+    parser.add_argument(
+        "--aggregate", help="Keep the per-sample mean, spread and extremes of each well over the shots of a --csv or --sweep batch with the same voltage and duration, written as one CSV each at the end", action='store_true'
+    )
+    parser.add_argument(
+        "--voltage", help="Target voltage in volts of the archived shot, for --reprocess", type=float
+    )
+    parser.add_argument(
+        "--duration", help="Pulse duration in milliseconds of the archived shot, for --reprocess", type=float
+    )
+    parser.add_argument(
+        "-j", "--jobs", help="Number of worker processes for --reprocess (default: all cores)", type=int
+    )
+    parser.add_argument(
+        "-l", "--ledger", help="SQLite file every executed command is recorded in", default=str(Path.home()) + "/zap-logs/ledger.sqlite"
+    )
+    parser.add_argument(
+        "--no-ledger", help="Don't record executed commands in the ledger", dest='no_ledger', action='store_true'
+    )
     parser.set_defaults(dry_run=False)
+    parser.set_defaults(schedule=False)
+    parser.set_defaults(resume=False)
+    parser.set_defaults(aggregate=False)
+    parser.set_defaults(pyramid=False)
     parser.set_defaults(verbose=False)
     parser.set_defaults(no_png=False)
+    parser.set_defaults(fast_png=False)
+    parser.set_defaults(plate_heatmap=False)
     parser.set_defaults(serialize=True)
     args = parser.parse_args()
 
-    try:
-        socket.inet_aton(args.target)
-        target_ip = args.target
-    except socket.error:
-        print('IP ' + args.target + ' is not valid')
-        exit(1)
+    targets = []
+    for target in args.target.split(','):
+        target_ip, _, log_dir = target.strip().partition('=')
+        try:
+            socket.inet_aton(target_ip)
+        except socket.error:
+            print('IP ' + target_ip + ' is not valid')
+            exit(1)
+        if log_dir and not log_dir.endswith('/'):
+            log_dir = log_dir + '/'
+        targets.append((target_ip, log_dir or LOG_DIR))
+    if len(targets) > 1:
+        if not (args.csv or args.sweep):
+            print('Only --csv and --sweep batches can be sharded across several targets')
+            exit(1)
+        if len(set(log_dir for ip, log_dir in targets)) < len(targets):
+            print('Warning: several targets share a capture directory, give each one as IP=DIR')
+
+    anomaly = None if args.anomaly == 'off' else args.anomaly
+    load_band = None
+    if args.load_band:
+        try:
+            load_band = tuple(float(x) for x in args.load_band.split(':'))
+        except ValueError:
+            load_band = ()
+        if len(load_band) != 2 or not 0 < load_band[0] <= load_band[1]:
+            print('Load band ' + args.load_band + ' is not of the form MIN:MAX ohms')
+            exit(1)
+
+    schedule_model = SCHEDULE_MODEL
+    if args.schedule_model:
+        try:
+            schedule_model = tuple(float(x) for x in args.schedule_model.split(':'))
+        except ValueError:
+            schedule_model = ()
+        if (len(schedule_model) != 4 or schedule_model[0] < 0 or schedule_model[1] <= 0 or
+                schedule_model[2] <= 0 or schedule_model[3] < 0):
+            print('Schedule model ' + args.schedule_model + ' is not of the form OVERHEAD:CHARGE:DISCHARGE:SWITCH with positive rates')
+            exit(1)
+
+    pins = []
+    for pin in args.pin:
+        m = re.match(r'([0-9.]+)=r(\d+)(?:c(\d+))?$', pin)
+        if m is None or m.group(1) not in [ip for ip, log_dir in targets]:
+            print('Pin ' + pin + ' is not of the form IP=rX or IP=rXcY with IP one of the targets')
+            exit(1)
+        pins.append((m.group(1), int(m.group(2)), int(m.group(3)) if m.group(3) else None))
+
+    ledger = None
+    if not args.no_ledger and not args.dry_run and not args.reprocess:
+        if args.watch:
+            # a watcher runs for days, so don't hold shots back for a batch
+            ledger = ZappyLedger(args.ledger, batch_size=1)
+        else:
+            ledger = ZappyLedger(args.ledger)
+
+    # one ZappyJSON per chassis, each writing under its own output prefix; a
+    # lone chassis exits on the first error like it always has, while shards
+    # and the spool watcher need errors back as results to carry on
+    exit_on_error = len(targets) == 1 and not args.watch
+    zappies = []
+    for ip, log_dir in targets:
+        prefix = args.prefix
+        if len(targets) > 1:
+            prefix = prefix + ip + '_'
+        zappies.append(ZappyJSON(ip, args.dry_run, args.verbose, prefix, args.no_png, args.serialize, ledger, log_dir, args.fast_png,
+                                 exit_on_error=exit_on_error, trim=args.trim, trim_margin=args.trim_margin,
+                                 trim_threshold=args.trim_threshold, keep_alive=bool(args.watch), plate_heatmap=args.plate_heatmap,
+                                 anomaly=anomaly, load_band=load_band, layout=args.layout,
+                                 post_jobs=None if args.reprocess else args.post_jobs, aggregate=args.aggregate,
+                                 pyramid=args.pyramid))
+    zappy = zappies[0]
 
     if args.file:
         json_file = args.file
@@ -386,36 +1996,106 @@ def main():
 
         with f:
             json_string = f.read()
-            zappy = ZappyJSON(target_ip, args.dry_run, args.verbose, args.prefix, args.no_png, args.serialize)
-            zappy.zap(json_string)
+            try:
+                zappy.zap(json_string)
+            finally:
+                zappy.close()
             exit(0)
 
     elif args.csv:
         csv_file = args.csv
 
         try:
+            checkpoint = BatchCheckpoint(args.checkpoint, file_hash(csv_file))
+            for z in zappies:
+                z.checkpoint = checkpoint
+            done = set()
+            if args.resume:
+                done = checkpoint.completed()
+                print('Resuming: skipping ' + str(len(done)) + ' rows already done')
+
             with open(csv_file, newline='') as f:
                 reader = csv.DictReader(f)
-                zappy = ZappyJSON(target_ip, args.dry_run, args.verbose, args.prefix, args.no_png, args.serialize)
-
-                for row in reader:
-                    command = {}
-                    command['voltage'] = str(row['voltage']) + ':volts'
-                    command['duration'] = str(row['duration']) + ':milliseconds'
-                    option={}
-                    option['row'] = str(row['row'])
-                    option['col'] = str(row['col'])
-                    option['max_current'] = str(row['max_current']) + ':amps'
-                    option['energy_cutoff'] = str(row['energy_cutoff']) + ':joules'
-                    command['option'] = option
-                    zappy.zap_inner(command)
+                total = None
 
-                exit(0)
+                if args.schedule:
+                    rows = list(reader)
+                    batch = [job for job in enumerate(csv_commands(rows), 1) if job[0] not in done]
+                    shots = []
+                    try:
+                        for batch_row, command in batch:
+                            v, time, row, col, max_current, energy_cutoff = zappy.parse_command(command)
+                            shots.append((v, time, row, col))
+                    except ZappyError:
+                        # parse_command() has printed why
+                        exit(1)
+                    groups = [row.get('group') for batch_row, row in enumerate(rows, 1) if batch_row not in done]
+                    batch, cost, naive = schedule_batch(batch, shots, groups, schedule_model)
+                    print('Schedule: model estimate of ' + '%.1f' % cost + 's versus ' + '%.1f' % naive +
+                          's in file order, with ' + ':'.join(str(x) for x in schedule_model) +
+                          ' for --schedule-model (not measured)')
+                    total = len(batch)
+                else:
+                    batch = (job for job in enumerate(csv_commands(reader), 1) if job[0] not in done)
+
+                failures = run_batch(zappies, batch, pins, total)
+                exit(1 if failures else 0)
 
         except IOError:
             print('Error opening file ' + csv_file)
             exit(1)
 
+    elif args.sweep:
+        sweep_file = args.sweep
+
+        try:
+            with open(sweep_file, 'rb') as f:
+                spec = json.loads(f.read())
+        except IOError:
+            print('Error opening file ' + sweep_file)
+            exit(1)
+        except ValueError as e:
+            print(e)
+            print('JSON grammar error decoding input string')
+            exit(1)
+
+        try:
+            sweep = ZappySweep(spec)
+        except (KeyError, TypeError, ValueError) as e:
+            print('Sweep spec error: ' + str(e))
+            exit(1)
+
+        # every parameter is range checked on its own, so the two extremes
+        # validate all the commands in between before anything is fired
+        try:
+            for command in sweep.corners():
+                zappy.parse_command(command)
+        except ZappyError:
+            # parse_command() has printed why
+            exit(1)
+        print('Sweep of ' + str(len(sweep)) + ' shots')
+        failures = run_batch(zappies, enumerate(sweep, 1), pins, len(sweep))
+        exit(1 if failures else 0)
+
+    elif args.watch:
+        try:
+            ZappySpool(args.watch, zappy, args.verbose).run()
+        except KeyboardInterrupt:
+            pass
+        exit(0)
+
+    elif args.reprocess:
+        if args.voltage is None or args.duration is None:
+            print('--reprocess needs the --voltage and --duration of the archived shot')
+            exit(1)
+
+        # the captures carry the same 1.0ms "pre-amble" as a live shot
+        failures = reprocess(args.reprocess, args.voltage, args.duration + 1.0, args.prefix,
+                             args.no_png, args.serialize, args.jobs, args.verbose, args.fast_png,
+                             args.trim, args.trim_margin, args.trim_threshold, anomaly, load_band, args.layout,
+                             args.pyramid)
+        exit(1 if failures else 0)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,215 @@
+#!/usr/bin/python3
+r"""SQLite ledger of executed zappy commands.
+
+Every command sent to a chassis is recorded as one row in the shots table,
+and every well whose capture was converted as one row in the wells table,
+so run history can be queried by time, well or voltage without listing and
+parsing the output filenames.
+
+Example:
+
+>>> from zappyledger import ZappyLedger
+>>> ledger = ZappyLedger('/home/ginkgo/zap-logs/ledger.sqlite')
+>>> for shot in ledger.shots(row=2, col=4, min_voltage=600, since='2026-10-12'):
+...     print(shot['time'], shot['voltage'], shot['status'])
+
+Inserts are buffered and written in one transaction per batch; the database
+runs in WAL mode so a dashboard can read it while a batch is writing.
+"""
+
+import argparse
+import atexit
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+
+__all__ = ["ZappyLedger"]
+
+# number of buffered shots that triggers a write
+BATCH_SIZE = 32
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS shots (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    name TEXT NOT NULL,
+    chassis TEXT,
+    status TEXT NOT NULL,
+    voltage REAL,
+    duration REAL,
+    row INTEGER,
+    col INTEGER,
+    max_current REAL,
+    energy_cutoff REAL,
+    energy_cutoff_counts INTEGER,
+    batch_row INTEGER,
+    parse_ms REAL,
+    chassis_ms REAL,
+    dump_ms REAL
+);
+CREATE TABLE IF NOT EXISTS wells (
+    shot_id INTEGER NOT NULL REFERENCES shots(id),
+    row INTEGER NOT NULL,
+    col INTEGER NOT NULL,
+    energy_counts INTEGER,
+    energy_joules REAL,
+    csv TEXT,
+    png TEXT,
+    anomalies TEXT
+);
+CREATE INDEX IF NOT EXISTS shots_time ON shots(time);
+CREATE INDEX IF NOT EXISTS shots_voltage ON shots(voltage);
+CREATE INDEX IF NOT EXISTS shots_well ON shots(row, col);
+CREATE INDEX IF NOT EXISTS wells_well ON wells(row, col);
+CREATE INDEX IF NOT EXISTS wells_shot ON wells(shot_id);
+"""
+
+SHOT_FIELDS = ('time', 'name', 'chassis', 'status', 'voltage', 'duration', 'row', 'col', 'max_current',
+               'energy_cutoff', 'energy_cutoff_counts', 'batch_row', 'parse_ms', 'chassis_ms', 'dump_ms')
+
+# columns added after the first release, for ledgers created before them
+MIGRATIONS = (
+    ('shots', 'batch_row', 'INTEGER'),
+    ('wells', 'anomalies', 'TEXT'),
+)
+
+
+class ZappyLedger():
+    def __init__(self, path, batch_size=BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self.pending = []
+        self.lock = threading.Lock()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        for table, column, kind in MIGRATIONS:
+            if column not in [r['name'] for r in self.db.execute('PRAGMA table_info(' + table + ')')]:
+                self.db.execute('ALTER TABLE ' + table + ' ADD COLUMN ' + column + ' ' + kind)
+        # exit() is how zap.py reports most errors, so make sure buffered
+        # shots still reach the disk when that happens
+        atexit.register(self.close)
+
+    def record(self, shot):
+        """Queue one shot for insertion.
+
+        shot is a dict with the keys in SHOT_FIELDS (missing ones are stored
+        as NULL) and optionally 'wells', a list of dicts as returned by
+        ZappyJSON.dump_well().
+        """
+        if 'time' not in shot:
+            shot['time'] = datetime.now().timestamp()
+        with self.lock:
+            self.pending.append(shot)
+            if len(self.pending) >= self.batch_size:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.pending or self.db is None:
+            return
+        with self.db:
+            for shot in self.pending:
+                cur = self.db.execute('INSERT INTO shots (' + ', '.join(SHOT_FIELDS) + ') VALUES (' +
+                                      ', '.join('?' * len(SHOT_FIELDS)) + ')',
+                                      [shot.get(k) for k in SHOT_FIELDS])
+                wells = shot.get('wells') or []
+                self.db.executemany('INSERT INTO wells (shot_id, row, col, energy_counts, energy_joules, csv, png, anomalies) '
+                                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                    [(cur.lastrowid, w['row'], w['col'], w.get('energy_counts'), w.get('energy_joules'),
+                                      w.get('csv'), w.get('png'), w.get('anomalies') or None) for w in wells])
+        self.pending = []
+
+    def close(self):
+        with self.lock:
+            if self.db is None:
+                return
+            self._flush()
+            self.db.close()
+            self.db = None
+
+    def shots(self, row=None, col=None, min_voltage=None, max_voltage=None, since=None, until=None, status=None):
+        """Return the shots matching all the given filters, oldest first.
+
+        row and col are 1-based and also match row and plate shots that
+        covered the well.  since and until are datetimes, ISO strings or unix
+        timestamps.
+        """
+        self.flush()
+        where = []
+        params = []
+        # row 5 and col 13 are how zap.py stores "all rows" / "all columns"
+        if row is not None:
+            where.append('row IN (?, 5)')
+            params.append(row)
+        if col is not None:
+            where.append('col IN (?, 13)')
+            params.append(col)
+        if min_voltage is not None:
+            where.append('voltage >= ?')
+            params.append(min_voltage)
+        if max_voltage is not None:
+            where.append('voltage <= ?')
+            params.append(max_voltage)
+        if since is not None:
+            where.append('time >= ?')
+            params.append(to_timestamp(since))
+        if until is not None:
+            where.append('time < ?')
+            params.append(to_timestamp(until))
+        if status is not None:
+            where.append('status = ?')
+            params.append(status)
+
+        query = 'SELECT * FROM shots'
+        if where:
+            query = query + ' WHERE ' + ' AND '.join(where)
+        return [dict(r) for r in self.db.execute(query + ' ORDER BY time', params)]
+
+    def wells(self, shot_id):
+        """Return the converted wells of one shot."""
+        self.flush()
+        return [dict(r) for r in self.db.execute('SELECT * FROM wells WHERE shot_id = ? ORDER BY row, col', (shot_id,))]
+
+
+def to_timestamp(when):
+    if isinstance(when, datetime):
+        return when.timestamp()
+    if isinstance(when, str):
+        return datetime.fromisoformat(when).timestamp()
+    return float(when)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the zappy shot ledger")
+    parser.add_argument("ledger", help="Ledger database file")
+    parser.add_argument("--row", type=int, help="Only shots that hit this row")
+    parser.add_argument("--col", type=int, help="Only shots that hit this column")
+    parser.add_argument("--min-voltage", type=float, dest='min_voltage')
+    parser.add_argument("--max-voltage", type=float, dest='max_voltage')
+    parser.add_argument("--since", help="ISO date or time, e.g. 2026-10-12")
+    parser.add_argument("--until", help="ISO date or time")
+    parser.add_argument("--status", help="zpass, zerr, timeout, error, anomaly or skipped")
+    args = parser.parse_args()
+
+    ledger = ZappyLedger(args.ledger)
+    print("time, name, chassis, status, voltage V, duration ms, row, col, energy J, files")
+    for shot in ledger.shots(args.row, args.col, args.min_voltage, args.max_voltage, args.since, args.until, args.status):
+        wells = ledger.wells(shot['id'])
+        energy = sum(w['energy_joules'] or 0.0 for w in wells)
+        files = ' '.join(w['csv'] for w in wells if w['csv'])
+        print(datetime.fromtimestamp(shot['time']).isoformat(sep=' ', timespec='milliseconds') + ', ' +
+              str(shot['name']) + ', ' + str(shot['chassis']) + ', ' + str(shot['status']) + ', ' +
+              str(shot['voltage']) + ', ' + str(shot['duration']) + ', ' + str(shot['row']) + ', ' +
+              str(shot['col']) + ', ' + '%.3f' % energy + ', ' + files)
+
+
+if __name__ == '__main__':
+    main()
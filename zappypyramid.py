@@ -0,0 +1,205 @@
+#!/usr/bin/python3
+r"""Multi-resolution waveform pyramids of zappy captures.
+
+A pyramid file keeps a well's slow/fast traces at several decimation levels:
+the raw 16-bit codes at 1x, and the min/max of every 16 and 256 samples, so
+a viewer can draw an overview of any shot from a few thousand points and
+only touch full detail for the window it zooms into.
+
+    bytes 0-3     b'ZPYR'
+    bytes 4-7     little-endian length of the JSON header that follows
+    JSON header   samples, offset, calibration and, per level, its factor,
+                  length, columns and start byte
+    byte 4096     1x level, (samples, 2) codes: slow, fast
+    after it      coarser levels, (buckets, 4) codes: slow min, slow max,
+                  fast min, fast max
+
+Every level is plain little-endian uint16 and opened with np.memmap, so
+reading a window of a large capture costs no more than the window.
+
+Example:
+
+>>> from zappypyramid import ZappyPyramid
+>>> pyramid = ZappyPyramid('/home/ginkgo/zap-logs/run_r1c1.pyr')
+>>> overview = pyramid.read(width=800)
+>>> detail = pyramid.read(1500, 1600, width=800)
+
+Times are in microseconds from the start of the capture, so trimmed
+captures keep their timing.
+"""
+
+import argparse
+import json
+import math
+import struct
+
+import numpy as np
+
+__all__ = ["PyramidWriter", "ZappyPyramid"]
+
+MAGIC = b'ZPYR'
+HEADER_SIZE = 4096
+FACTORS = (1, 16, 256)
+
+
+class PyramidWriter():
+    """Streams one well's codes into a pyramid file.
+
+    add() takes the capture in order, in chunks that start on a multiple of
+    the largest factor (all but the last are whole multiples of it), which
+    is what a WellSink with align set to that factor gets.  The coarse
+    levels are small and kept in memory until close().
+    """
+    def __init__(self, path, samples, offset=0, calibration=None, factors=FACTORS):
+        if factors[0] != 1:
+            raise ValueError("the first level has to be the 1x one")
+        self.path = path
+        self.samples = samples
+        self.factors = factors
+        self.index = 0
+        self.coarse = {}
+        levels = []
+        start = HEADER_SIZE
+        for factor in factors:
+            length = -(-samples // factor)
+            columns = 2 if factor == 1 else 4
+            levels.append({'factor': factor, 'length': length, 'columns': columns, 'start': start})
+            start = start + length * columns * 2
+            if factor != 1:
+                self.coarse[factor] = np.empty((length, 4), dtype='<u2')
+        header = json.dumps({
+            'version': 1,
+            'samples': samples,
+            'offset': offset,
+            'calibration': calibration,
+            'levels': levels,
+        }).encode('utf-8')
+        if len(header) + 8 > HEADER_SIZE:
+            raise ValueError("too many levels for the pyramid header")
+
+        self.f = open(path, 'wb')
+        self.f.write(MAGIC + struct.pack('<I', len(header)) + header)
+        self.f.write(bytes(HEADER_SIZE - 8 - len(header)))
+
+    def add(self, slow, fast):
+        n = len(slow)
+        if n == 0:
+            return
+        pairs = np.empty((n, 2), dtype='<u2')
+        pairs[:, 0] = slow
+        pairs[:, 1] = fast
+        self.f.write(pairs.tobytes())
+        for factor, level in self.coarse.items():
+            starts = np.arange(0, n, factor)
+            at = self.index // factor
+            level[at:at + len(starts), 0] = np.minimum.reduceat(slow, starts)
+            level[at:at + len(starts), 1] = np.maximum.reduceat(slow, starts)
+            level[at:at + len(starts), 2] = np.minimum.reduceat(fast, starts)
+            level[at:at + len(starts), 3] = np.maximum.reduceat(fast, starts)
+        self.index = self.index + n
+
+    def close(self):
+        for factor in self.factors[1:]:
+            self.f.write(self.coarse[factor].tobytes())
+        self.f.close()
+
+
+class PyramidView():
+    """What ZappyPyramid.read() returns: bucket start times in microseconds
+    and the min/max volts of both traces per bucket; at factor 1 min and max
+    are the same samples."""
+    def __init__(self, factor, t, slow_min, slow_max, fast_min, fast_max):
+        self.factor = factor
+        self.t = t
+        self.slow_min = slow_min
+        self.slow_max = slow_max
+        self.fast_min = fast_min
+        self.fast_max = fast_max
+
+    def __repr__(self):
+        return '<PyramidView ' + str(self.factor) + 'x ' + str(len(self.t)) + ' points>'
+
+
+class ZappyPyramid():
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            head = f.read(HEADER_SIZE)
+        if head[:4] != MAGIC:
+            raise ValueError(path + " is not a zappy pyramid")
+        length = struct.unpack('<I', head[4:8])[0]
+        self.header = json.loads(head[8:8 + length].decode('utf-8'))
+        self.samples = self.header['samples']
+        self.offset = self.header['offset']
+        self.calibration = self.header['calibration']
+        # finest first
+        self.levels = []
+        for level in self.header['levels']:
+            shape = (level['length'], level['columns'])
+            if level['length'] == 0:
+                codes = np.zeros(shape, dtype='<u2')
+            else:
+                codes = np.memmap(path, dtype='<u2', mode='r', offset=level['start'], shape=shape)
+            self.levels.append((level['factor'], codes))
+
+    def volts(self, codes, trace):
+        if self.calibration is None:
+            return codes.astype(np.float64)
+        adc = self.calibration['adc']
+        m, b = self.calibration[trace]
+        return (codes * (adc / 4096) - adc / 8192) * m + b
+
+    def level(self, t0=None, t1=None, width=None):
+        """Factor of the coarsest level with at least width points between t0
+        and t1, or 1 when none has; width None always gives 1."""
+        t0, t1 = self.span(t0, t1)
+        best = 1
+        if width is not None:
+            for factor, codes in self.levels:
+                if (t1 - t0) / factor >= width:
+                    best = max(best, factor)
+        return best
+
+    # t0 and t1 clamped to the capture and widened to whole microseconds
+    def span(self, t0, t1):
+        start = self.offset
+        stop = self.offset + self.samples
+        t0 = start if t0 is None else min(max(math.floor(t0), start), stop)
+        t1 = stop if t1 is None else min(max(math.ceil(t1), t0), stop)
+        return t0, t1
+
+    def read(self, t0=None, t1=None, width=None):
+        """The traces between t0 and t1 microseconds (default all of them)
+        from the coarsest level that still gives width points."""
+        t0, t1 = self.span(t0, t1)
+        factor = self.level(t0, t1, width)
+        codes = dict(self.levels)[factor]
+        lo = (t0 - self.offset) // factor
+        hi = -(-(t1 - self.offset) // factor)
+        window = np.asarray(codes[lo:hi])
+        t = self.offset + np.arange(lo, hi) * factor
+        if factor == 1:
+            slow = self.volts(window[:, 0], 'slow')
+            fast = self.volts(window[:, 1], 'fast')
+            return PyramidView(factor, t, slow, slow, fast, fast)
+        return PyramidView(factor, t, self.volts(window[:, 0], 'slow'), self.volts(window[:, 1], 'slow'),
+                           self.volts(window[:, 2], 'fast'), self.volts(window[:, 3], 'fast'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print a window of a zappy waveform pyramid as CSV")
+    parser.add_argument("pyramid", help="Pyramid file written by zap.py --pyramid")
+    parser.add_argument("--start", type=int, help="First microsecond of the window")
+    parser.add_argument("--stop", type=int, help="Microsecond just past the window")
+    parser.add_argument("--width", type=int, help="Points wanted across the window; picks the coarsest level that has them")
+    args = parser.parse_args()
+
+    view = ZappyPyramid(args.pyramid).read(args.start, args.stop, args.width)
+    print("level, " + str(view.factor) + ", x")
+    print("time us, slow min V, slow max V, fast min V, fast max V")
+    for row in zip(view.t, view.slow_min, view.slow_max, view.fast_min, view.fast_max):
+        print(', '.join(str(x) for x in row))
+
+
+if __name__ == '__main__':
+    main()
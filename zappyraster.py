@@ -0,0 +1,200 @@
+r"""Lightweight waveform thumbnails without matplotlib.
+
+Traces are rasterized straight into an RGB pixel buffer, column by column,
+and written out as a PNG with nothing but zlib.  Text uses a built-in 5x7
+font (upper case, digits and a little punctuation), which is plenty for a
+title and axis labels.
+
+Example:
+
+>>> import numpy as np
+>>> from zappyraster import render_waveform, BLUE
+>>> t = np.arange(1000)
+>>> render_waveform('/tmp/thumb.png', t, [(t * 0.5, BLUE, 'ON CELL')], 600.0, 'TEST')
+
+This takes a few milliseconds per image where the matplotlib path in
+zap.py takes on the order of a second; use that one for figures that
+need to look good.
+"""
+
+import struct
+import zlib
+
+import numpy as np
+
+__all__ = ["render_heatmap", "render_waveform", "write_png"]
+
+WIDTH = 800
+HEIGHT = 400
+# room around the plot area for the title and axis labels
+MARGIN_LEFT = 48
+MARGIN_RIGHT = 12
+MARGIN_TOP = 22
+MARGIN_BOTTOM = 20
+
+WHITE = (255, 255, 255)
+BLACK = (0, 0, 0)
+RED = (255, 0, 0)
+BLUE = (0, 0, 255)
+GRAY = (192, 192, 192)
+# a few stops of the viridis colormap, low to high, for heatmaps
+RAMP = np.array([(68, 1, 84), (59, 82, 139), (33, 145, 140), (94, 201, 98), (253, 231, 37)], dtype=np.float64)
+# traces are blended over what is already drawn, like alpha=0.5 in pyplot
+ALPHA = 0.5
+
+# 5x7 glyphs for ' ' (0x20) through 'Z' (0x5A), five column bytes each with
+# bit 0 at the top
+FONT = bytes.fromhex(
+    '0000000000' '00005f0000' '0007000700' '147f147f14' '242a7f2a12' '2313086462'
+    '3649562050' '0008070300' '001c224100' '0041221c00' '2a1c7f1c2a' '08083e0808'
+    '0080703000' '0808080808' '0000606000' '2010080402' '3e5149453e' '00427f4000'
+    '7249494946' '2141494d33' '1814127f10' '2745454539' '3c4a494931' '4121110907'
+    '3649494936' '464949291e' '0000140000' '0040340000' '0008142241' '1414141414'
+    '0041221408' '0201590906' '3e415d594e' '7c1211127c' '7f49494936' '3e41414122'
+    '7f4141413e' '7f49494941' '7f09090901' '3e41415173' '7f0808087f' '00417f4100'
+    '2040413f01' '7f08142241' '7f40404040' '7f021c027f' '7f0408107f' '3e4141413e'
+    '7f09090906' '3e4151215e' '7f09192946' '2649494932' '03017f0103' '3f4040403f'
+    '1f2040201f' '3f4038403f' '6314081463' '0304780403' '6151494543'
+)
+
+
+def write_png(path, img):
+    """Write an (height, width, 3) uint8 array as an 8-bit RGB PNG."""
+    height, width = img.shape[0], img.shape[1]
+    # filter type 0 (none) in front of every scanline
+    raw = np.empty((height, width * 3 + 1), dtype=np.uint8)
+    raw[:, 0] = 0
+    raw[:, 1:] = img.reshape(height, width * 3)
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)))
+        f.write(chunk(b'IEND', b''))
+
+
+def draw_text(img, x, y, text, color=BLACK):
+    """Draw text with its top left corner at (x, y); returns the x just past it."""
+    for ch in text.upper():
+        code = ord(ch) - 0x20
+        if code < 0 or code * 5 >= len(FONT):
+            code = ord('?') - 0x20
+        for col in range(5):
+            bits = FONT[code * 5 + col]
+            for row in range(7):
+                if bits & (1 << row) and 0 <= y + row < img.shape[0] and 0 <= x + col < img.shape[1]:
+                    img[y + row, x + col] = color
+        x = x + 6
+    return x
+
+
+def draw_trace(img, t, y, tmax, ymax, color):
+    """Rasterize one trace into the plot area of img.
+
+    Each pixel column gets a vertical span from the lowest to the highest
+    sample falling in it, stretched to meet the previous column so steep
+    edges stay connected.  All of it is vectorized over the samples.
+    """
+    height, width = img.shape[0], img.shape[1]
+    pw = width - MARGIN_LEFT - MARGIN_RIGHT
+    ph = height - MARGIN_TOP - MARGIN_BOTTOM
+    if len(t) == 0 or tmax <= 0 or ymax <= 0:
+        return
+
+    px = np.clip((np.asarray(t, dtype=np.float64) * (pw - 1) / tmax).astype(np.int64), 0, pw - 1)
+    py = np.clip(((ph - 1) - np.asarray(y, dtype=np.float64) * (ph - 1) / ymax).round().astype(np.int64), 0, ph - 1)
+
+    # samples are in time order, so each column is one contiguous run
+    starts = np.flatnonzero(np.r_[True, px[1:] != px[:-1]])
+    cols = px[starts]
+    lo = np.minimum.reduceat(py, starts)
+    hi = np.maximum.reduceat(py, starts)
+    last = py[np.r_[starts[1:] - 1, len(py) - 1]]
+    lo[1:] = np.minimum(lo[1:], last[:-1])
+    hi[1:] = np.maximum(hi[1:], last[:-1])
+
+    rows = np.arange(ph)[:, None]
+    mask = np.zeros((ph, pw), dtype=bool)
+    mask[:, cols] = (rows >= lo) & (rows <= hi)
+    area = img[MARGIN_TOP:MARGIN_TOP + ph, MARGIN_LEFT:MARGIN_LEFT + pw]
+    area[mask] = (area[mask] * (1 - ALPHA) + np.array(color) * ALPHA).astype(np.uint8)
+
+
+def render_waveform(path, t, traces, ymax, title, xlabel='US', ylabel='V', width=WIDTH, height=HEIGHT):
+    """Render traces against t into a PNG at path.
+
+    traces is a list of (values, color, label); values line up with t.  The
+    y axis runs from 0 to ymax and the x axis from 0 to the last t.
+    """
+    img = np.empty((height, width, 3), dtype=np.uint8)
+    img[:] = WHITE
+    tmax = float(t[-1]) if len(t) else 0.0
+
+    for values, color, label in traces:
+        draw_trace(img, t, values, tmax, ymax, color)
+
+    # axes along the left and bottom of the plot area, with end labels
+    bottom = height - MARGIN_BOTTOM
+    img[MARGIN_TOP:bottom + 1, MARGIN_LEFT - 1] = BLACK
+    img[bottom, MARGIN_LEFT - 1:width - MARGIN_RIGHT] = BLACK
+    draw_text(img, 2, MARGIN_TOP, '%.0f' % ymax)
+    draw_text(img, 2, MARGIN_TOP + 9, ylabel)
+    draw_text(img, 2, bottom - 7, '0')
+    draw_text(img, MARGIN_LEFT, bottom + 4, '0')
+    end = '%d' % tmax + ' ' + xlabel
+    draw_text(img, width - MARGIN_RIGHT - 6 * len(end), bottom + 4, end)
+
+    draw_text(img, MARGIN_LEFT, 6, title)
+    # legend in the lower right corner, like loc='lower right'
+    x = width - MARGIN_RIGHT - 4 - sum(10 + 6 * len(label) + 12 for values, color, label in traces)
+    for values, color, label in traces:
+        img[bottom - 12:bottom - 5, x:x + 7] = color
+        x = draw_text(img, x + 10, bottom - 12, label) + 12
+
+    write_png(path, img)
+
+
+def render_heatmap(path, values, title, cell_width=56, cell_height=28):
+    """Render a 2D array as a grid of colored cells, each labelled with its value.
+
+    Rows are labelled R1.. and columns 1..; NaN cells are drawn gray.  The
+    color ramp runs from the smallest to the largest value.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    rows, cols = values.shape
+    left = MARGIN_LEFT // 2
+    top = MARGIN_TOP + 12
+    width = left + cols * cell_width + MARGIN_RIGHT
+    height = top + rows * cell_height + MARGIN_BOTTOM
+    img = np.empty((height, width, 3), dtype=np.uint8)
+    img[:] = WHITE
+
+    finite = np.isfinite(values)
+    lo = values[finite].min() if finite.any() else 0.0
+    hi = values[finite].max() if finite.any() else 0.0
+    scaled = np.where(finite, (values - lo) / (hi - lo) if hi > lo else 0.5, 0.0) * (len(RAMP) - 1)
+    stop = np.minimum(scaled.astype(np.int64), len(RAMP) - 2)
+    frac = (scaled - stop)[..., None]
+    colors = (RAMP[stop] * (1 - frac) + RAMP[stop + 1] * frac).astype(np.uint8)
+    colors[~finite] = GRAY
+
+    for r in range(rows):
+        y = top + r * cell_height
+        draw_text(img, 2, y + (cell_height - 7) // 2, 'R' + str(r + 1))
+        for c in range(cols):
+            x = left + c * cell_width
+            img[y + 1:y + cell_height, x + 1:x + cell_width] = colors[r, c]
+            if finite[r, c]:
+                label = '%.3f' % values[r, c]
+                # dark text on the light end of the ramp
+                ink = BLACK if colors[r, c].astype(np.int64).sum() > 380 else WHITE
+                draw_text(img, x + (cell_width - 6 * len(label)) // 2, y + (cell_height - 7) // 2, label, ink)
+    for c in range(cols):
+        draw_text(img, left + c * cell_width + cell_width // 2 - 3, top - 10, str(c + 1))
+
+    draw_text(img, left, 6, title)
+    draw_text(img, left, height - MARGIN_BOTTOM + 6, 'MIN %.3f' % lo + '  MAX %.3f' % hi)
+    write_png(path, img)
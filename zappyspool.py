@@ -0,0 +1,199 @@
+r"""Spool-directory command queue for one chassis.
+
+Lab machines drop JSON command files (the same ones zap.py -f takes) into a
+spool directory, and one watcher fires them in name order over a single
+telnet session that stays open between commands:
+
+    spool/          new commands; write them elsewhere and rename them in,
+                    names starting with '.' are ignored
+    spool/work/     commands claimed by the watcher, renamed here with a
+                    timestamp prefix before they are fired
+    spool/done/     commands the chassis passed
+    spool/failed/   everything else, each with a .status file next to it
+    spool/journal   append-only record of every command fired
+
+Each command is journalled as 'start' before it is sent and as 'end' with
+its status after, both fsync'd.  After a crash or reboot a claimed command
+with an end is just filed, one with a start but no end may or may not
+have reached the chassis and goes to failed/ as 'interrupted' rather than
+being fired twice, and one without a start is run as normal.
+
+Example:
+
+>>> from zap import ZappyJSON
+>>> from zappyspool import ZappySpool
+>>> zappy = ZappyJSON('10.0.11.2', exit_on_error=False, keep_alive=True)
+>>> ZappySpool('/var/spool/zappy', zappy).run()
+
+New files are noticed through inotify on Linux, with a directory poll as
+the fallback where that is not available.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import time
+from datetime import datetime
+
+__all__ = ["ZappySpool"]
+
+# seconds between directory scans when inotify is not available, and the
+# longest inotify wait, so a missed event is never fatal
+POLL_INTERVAL = 1.0
+WATCH_INTERVAL = 60.0
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+
+# statuses that send a command to done/ rather than failed/
+DONE_STATUSES = ('zpass', 'dry_run')
+
+
+# a rename only survives a crash once both directories it touched are synced
+def sync_dirs(*paths):
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class Inotify():
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, 'inotify_add_watch failed on ' + path)
+
+    # block until something lands in the directory or timeout runs out; the
+    # events themselves are dropped since the caller rescans anyway
+    def wait(self, timeout):
+        if select.select([self.fd], [], [], timeout)[0]:
+            try:
+                while os.read(self.fd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ZappySpool():
+    def __init__(self, path, zappy, verbose=False):
+        self.path = path
+        self.zappy = zappy
+        self.verbose = verbose
+        self.work = os.path.join(path, 'work')
+        self.done = os.path.join(path, 'done')
+        self.failed = os.path.join(path, 'failed')
+        for d in (self.work, self.done, self.failed):
+            os.makedirs(d, exist_ok=True)
+        self.journal = open(os.path.join(path, 'journal'), 'a')
+
+    def log(self, event, claimed, status=''):
+        self.journal.write(datetime.now().isoformat(sep=' ', timespec='milliseconds') + '\t' + event + '\t' +
+                           claimed + '\t' + status + '\n')
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    # last journal event and status of every claimed command
+    def read_journal(self):
+        events = {}
+        with open(os.path.join(self.path, 'journal')) as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) == 4:
+                    events[fields[2]] = (fields[1], fields[3])
+        return events
+
+    # file away whatever a previous run left in work/
+    def recover(self):
+        events = self.read_journal()
+        for claimed in sorted(os.listdir(self.work)):
+            event, status = events.get(claimed, (None, ''))
+            if event == 'end':
+                self.file(claimed, status)
+            elif event == 'start':
+                print(claimed + ' was interrupted after it was sent, not firing it again')
+                self.log('end', claimed, 'interrupted')
+                self.file(claimed, 'interrupted')
+            else:
+                self.fire(claimed)
+
+    def pending(self):
+        return sorted(name for name in os.listdir(self.path)
+                      if name.endswith('.json') and not name.startswith('.')
+                      and os.path.isfile(os.path.join(self.path, name)))
+
+    # the rename is the claim: whoever gets it owns the command.  It is synced
+    # before fire() journals the start, so the journal never names a claim
+    # that a crash undid and the command can't be claimed and fired twice
+    def claim(self, name):
+        claimed = datetime.now().strftime("%Y_%m_%d-%H_%M_%S.%f") + '-' + name
+        try:
+            os.rename(os.path.join(self.path, name), os.path.join(self.work, claimed))
+        except FileNotFoundError:
+            return None
+        sync_dirs(self.work, self.path)
+        return claimed
+
+    def fire(self, claimed):
+        with open(os.path.join(self.work, claimed), 'rb') as f:
+            json_string = f.read()
+        self.log('start', claimed)
+        try:
+            result = self.zappy.zap(json_string)
+            status = result.status
+            message = result.message
+        except Exception as e:
+            status = 'error'
+            message = str(e)
+        self.log('end', claimed, status)
+        if self.verbose or status not in DONE_STATUSES:
+            print(claimed + ': ' + status + (' ' + message if message else ''))
+        self.file(claimed, status, message)
+
+    def file(self, claimed, status, message=None):
+        dest = self.done if status in DONE_STATUSES else self.failed
+        if dest == self.failed:
+            with open(os.path.join(dest, claimed + '.status'), 'w') as f:
+                print(status + (', ' + message if message else ''), file=f)
+        os.rename(os.path.join(self.work, claimed), os.path.join(dest, claimed))
+        sync_dirs(dest, self.work)
+
+    def run(self, once=False):
+        """Fire spooled commands one at a time, oldest name first, until
+        interrupted; with once, stop when the spool is empty."""
+        self.recover()
+        try:
+            watcher = Inotify(self.path)
+        except (OSError, AttributeError):
+            watcher = None
+        try:
+            while True:
+                # rescan after every command so a newly spooled file that
+                # sorts first still goes first
+                names = self.pending()
+                if names:
+                    claimed = self.claim(names[0])
+                    if claimed is not None:
+                        self.fire(claimed)
+                elif once:
+                    return
+                elif watcher is not None:
+                    watcher.wait(WATCH_INTERVAL)
+                else:
+                    time.sleep(POLL_INTERVAL)
+        finally:
+            if watcher is not None:
+                watcher.close()
+            self.zappy.close()
+            self.journal.close()
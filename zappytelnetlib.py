@@ -33,6 +33,7 @@ To do:
 
 
 # Imported modules
+import re
 import sys
 import socket
 import selectors
@@ -42,6 +43,8 @@ __all__ = ["Telnet"]
 
 # Tunable parameters
 DEBUGLEVEL = 0
+# Size of the receive buffer filled by each recv_into() call
+RECV_SIZE = 4096
 
 # Telnet protocol defaults
 TELNET_PORT = 23
@@ -130,6 +133,13 @@ EXOPL = bytes([255]) # Extended-Options-List
 NOOPT = bytes([0])
 
 
+# Bytes that need per-character handling in process_rawq(); everything
+# between them is copied over to the cooked queue in one go
+_SPECIAL = re.compile(b'[\x00\x11\xff]')
+# One-byte bytes objects, so handing out a character doesn't allocate
+_BYTES = [bytes([i]) for i in range(256)]
+
+
 # poll/select have the advantage of not requiring any extra file descriptor,
 # contrarily to epoll/kqueue (also, they require a single syscall).
 if hasattr(selectors, 'PollSelector'):
@@ -206,9 +216,14 @@ class Telnet:
         self.port = port
         self.timeout = timeout
         self.sock = None
-        self.rawq = b''
+        self.selector = None
+        # raw data is received into a fixed buffer; rawbuf[irawq:rawlen] is
+        # what has not been processed yet
+        self.rawbuf = bytearray(RECV_SIZE)
+        self.rawview = memoryview(self.rawbuf)
         self.irawq = 0
-        self.cookedq = b''
+        self.rawlen = 0
+        self.cookedq = bytearray()
         self.eof = 0
         self.iacseq = b'' # Buffer for IAC sequence.
         self.sb = 0 # flag for SB and SE sequence.
@@ -232,6 +247,10 @@ class Telnet:
         self.port = port
         self.timeout = timeout
         self.sock = socket.create_connection((host, port), timeout)
+        # one selector for the lifetime of the connection instead of one per
+        # read_until()/expect()/sock_avail() call
+        self.selector = _TelnetSelector()
+        self.selector.register(self, selectors.EVENT_READ)
 
     def __del__(self):
         """Destructor -- close the connection."""
@@ -262,10 +281,14 @@ class Telnet:
     def close(self):
         """Close the connection."""
         sock = self.sock
+        selector = self.selector
         self.sock = None
+        self.selector = None
         self.eof = True
         self.iacseq = b''
         self.sb = 0
+        if selector:
+            selector.close()
         if sock:
             sock.close()
 
@@ -301,29 +324,21 @@ class Telnet:
         self.process_rawq()
         i = self.cookedq.find(match)
         if i >= 0:
-            i = i+n
-            buf = self.cookedq[:i]
-            self.cookedq = self.cookedq[i:]
-            return buf
+            return self.take_cookedq(i+n)
         if timeout is not None:
             deadline = _time() + timeout
-        with _TelnetSelector() as selector:
-            selector.register(self, selectors.EVENT_READ)
-            while not self.eof:
-                if selector.select(timeout):
-                    i = max(0, len(self.cookedq)-n)
-                    self.fill_rawq()
-                    self.process_rawq()
-                    i = self.cookedq.find(match, i)
-                    if i >= 0:
-                        i = i+n
-                        buf = self.cookedq[:i]
-                        self.cookedq = self.cookedq[i:]
-                        return buf
-                if timeout is not None:
-                    timeout = deadline - _time()
-                    if timeout < 0:
-                        break
+        while not self.eof:
+            if self.selector.select(timeout):
+                i = max(0, len(self.cookedq)-n)
+                self.fill_rawq()
+                self.process_rawq()
+                i = self.cookedq.find(match, i)
+                if i >= 0:
+                    return self.take_cookedq(i+n)
+            if timeout is not None:
+                timeout = deadline - _time()
+                if timeout < 0:
+                    break
         return self.read_very_lazy()
 
     def read_all(self):
@@ -332,9 +347,7 @@ class Telnet:
         while not self.eof:
             self.fill_rawq()
             self.process_rawq()
-        buf = self.cookedq
-        self.cookedq = b''
-        return buf
+        return self.take_cookedq()
 
     def read_some(self):
         """Read at least one byte of cooked data unless EOF is hit.
@@ -347,9 +360,7 @@ class Telnet:
         while not self.cookedq and not self.eof:
             self.fill_rawq()
             self.process_rawq()
-        buf = self.cookedq
-        self.cookedq = b''
-        return buf
+        return self.take_cookedq()
 
     def read_very_eager(self):
         """Read everything that's possible without blocking in I/O (eager).
@@ -397,12 +408,26 @@ class Telnet:
         Return b'' if no cooked data available otherwise.  Don't block.
 
         """
-        buf = self.cookedq
-        self.cookedq = b''
-        if not buf and self.eof and not self.rawq:
+        buf = self.take_cookedq()
+        if not buf and self.eof and self.irawq >= self.rawlen:
             raise EOFError('telnet connection closed')
         return buf
 
+    def take_cookedq(self, n=None):
+        """Remove and return the first n bytes (default all) of the cooked queue.
+
+        The queue is a bytearray that is trimmed in place, so the only
+        allocation is the bytes object handed back.
+        """
+        if n is None or n >= len(self.cookedq):
+            buf = bytes(self.cookedq)
+            self.cookedq.clear()
+            return buf
+        with memoryview(self.cookedq) as view:
+            buf = view[:n].tobytes()
+        del self.cookedq[:n]
+        return buf
+
     def read_sb_data(self):
         """Return any data available in the SB ... SE queue.
 
@@ -426,9 +451,20 @@ class Telnet:
         the midst of an IAC sequence.
 
         """
-        buf = [b'', b'']
+        buf = [self.cookedq, bytearray()]
         try:
-            while self.rawq:
+            while self.irawq < self.rawlen:
+                if not self.iacseq:
+                    # copy plain data up to the next special byte straight
+                    # out of the receive buffer
+                    m = _SPECIAL.search(self.rawbuf, self.irawq, self.rawlen)
+                    end = m.start() if m else self.rawlen
+                    if end > self.irawq:
+                        buf[self.sb] += self.rawview[self.irawq:end]
+                        self.irawq = end
+                        if end == self.rawlen:
+                            self.irawq = self.rawlen = 0
+                        continue
                 c = self.rawq_getchar()
                 if not self.iacseq:
                     if c == theNULL:
@@ -436,7 +472,7 @@ class Telnet:
                     if c == b"\021":
                         continue
                     if c != IAC:
-                        buf[self.sb] = buf[self.sb] + c
+                        buf[self.sb] += c
                         continue
                     else:
                         self.iacseq += c
@@ -448,15 +484,15 @@ class Telnet:
 
                     self.iacseq = b''
                     if c == IAC:
-                        buf[self.sb] = buf[self.sb] + c
+                        buf[self.sb] += c
                     else:
                         if c == SB: # SB ... SE start.
                             self.sb = 1
                             self.sbdataq = b''
                         elif c == SE:
                             self.sb = 0
-                            self.sbdataq = self.sbdataq + buf[1]
-                            buf[1] = b''
+                            self.sbdataq = self.sbdataq + bytes(buf[1])
+                            buf[1] = bytearray()
                         if self.option_callback:
                             # Callback is supposed to look into
                             # the sbdataq
@@ -488,8 +524,8 @@ class Telnet:
             self.iacseq = b'' # Reset on EOF
             self.sb = 0
             pass
-        self.cookedq = self.cookedq + buf[0]
-        self.sbdataq = self.sbdataq + buf[1]
+        # buf[0] is the cooked queue itself, extended in place
+        self.sbdataq = self.sbdataq + bytes(buf[1])
 
     def rawq_getchar(self):
         """Get next char from raw queue.
@@ -498,15 +534,14 @@ class Telnet:
         when connection is closed.
 
         """
-        if not self.rawq:
+        if self.irawq >= self.rawlen:
             self.fill_rawq()
             if self.eof:
                 raise EOFError
-        c = self.rawq[self.irawq:self.irawq+1]
+        c = _BYTES[self.rawbuf[self.irawq]]
         self.irawq = self.irawq + 1
-        if self.irawq >= len(self.rawq):
-            self.rawq = b''
-            self.irawq = 0
+        if self.irawq >= self.rawlen:
+            self.irawq = self.rawlen = 0
         return c
 
     def fill_rawq(self):
@@ -516,21 +551,23 @@ class Telnet:
         connection is closed.
 
         """
-        if self.irawq >= len(self.rawq):
-            self.rawq = b''
+        if self.irawq >= self.rawlen:
+            self.irawq = self.rawlen = 0
+        elif self.rawlen == len(self.rawbuf):
+            # full: move the unprocessed tail to the front to make room
+            n = self.rawlen - self.irawq
+            self.rawbuf[:n] = self.rawview[self.irawq:self.rawlen].tobytes()
             self.irawq = 0
-        # The buffer size should be fairly small so as to avoid quadratic
-        # behavior in process_rawq() above
-        buf = self.sock.recv(50)
-        self.msg("recv %r", buf)
-        self.eof = (not buf)
-        self.rawq = self.rawq + buf
+            self.rawlen = n
+        n = self.sock.recv_into(self.rawview[self.rawlen:])
+        if self.debuglevel > 0:
+            self.msg("recv %r", self.rawview[self.rawlen:self.rawlen+n].tobytes())
+        self.eof = (n == 0)
+        self.rawlen = self.rawlen + n
 
     def sock_avail(self):
         """Test whether data is available on the socket."""
-        with _TelnetSelector() as selector:
-            selector.register(self, selectors.EVENT_READ)
-            return bool(selector.select(0))
+        return bool(self.selector.select(0))
 
     def interact(self):
         """Interaction function, emulates a very dumb telnet client."""
@@ -612,26 +649,23 @@ class Telnet:
                 list[i] = re.compile(list[i])
         if timeout is not None:
             deadline = _time() + timeout
-        with _TelnetSelector() as selector:
-            selector.register(self, selectors.EVENT_READ)
-            while not self.eof:
-                self.process_rawq()
-                for i in indices:
-                    m = list[i].search(self.cookedq.decode('utf-8'))
-                    if m:
-                        e = m.end()
-                        text = self.cookedq[:e]
-                        self.cookedq = self.cookedq[e:]
-                        return (i, m, text)
-                if timeout is not None:
-                    ready = selector.select(timeout)
-                    timeout = deadline - _time()
-                    if not ready:
-                        if timeout < 0:
-                            break
-                        else:
-                            continue
-                self.fill_rawq()
+        while not self.eof:
+            self.process_rawq()
+            cooked = self.cookedq.decode('utf-8')
+            for i in indices:
+                m = list[i].search(cooked)
+                if m:
+                    text = self.take_cookedq(m.end())
+                    return (i, m, text)
+            if timeout is not None:
+                ready = self.selector.select(timeout)
+                timeout = deadline - _time()
+                if not ready:
+                    if timeout < 0:
+                        break
+                    else:
+                        continue
+            self.fill_rawq()
         text = self.read_very_lazy()
         if not text and self.eof:
             raise EOFError